@@ -26,36 +26,29 @@ configParser = configparser.ConfigParser()
 configParser.read(options.config)
 
 ref_date = datetime.strptime(options.date + "2359", "%Y%m%d%H%M")
+ref_timestamp = ref_date.timestamp()
 
 # Utility Functions
 
 financial_period_map = { "1stQuarterly" : 0, "Interim" : 1, "3rdQuarterly" : 2, "Final" : 3 }
 
-def get_latest_industry(f, code):
-    recs = records.get_records(f, str(code))
-    recs = [ r for r in recs if datetime.fromtimestamp(r[1]) <= ref_date ]
+def get_latest_industry(recs):
     if len(recs) < 1:
         return None
     return recs[-1][2]
 
-def get_latest_sector(f, code):
-    recs = records.get_records(f, str(code))
-    recs = [ r for r in recs if datetime.fromtimestamp(r[1]) <= ref_date ]
+def get_latest_sector(recs):
     if len(recs) < 1:
         return None
     return recs[-1][3]
 
-def get_latest_ratings(f, code):
-    recs = records.get_records(f, str(code))
-    recs = [ r for r in recs if datetime.fromtimestamp(r[1]) <= ref_date ]
+def get_latest_ratings(recs):
     if len(recs) < 1:
         return None
     ratings = batch.Ratings(buy_analysts=int(recs[-1][2]), outperform_analysts=int(recs[-1][3]), hold_analysts=int(recs[-1][4]), underperform_analysts=int(recs[-1][5]), sell_analysts=int(recs[-1][6]), target_high=float(recs[-1][7]), target_low=float(recs[-1][8]), target_median=float(recs[-1][9]), target=float(recs[-1][10]))
     return ratings
 
-def get_latest_forecasts(f, code):
-    recs = records.get_records(f, str(code))
-    recs = [ r for r in recs if datetime.fromtimestamp(r[1]) <= ref_date ]
+def get_latest_forecasts(recs):
     forecasts = {}
     if len(recs) < 1:
         return forecasts
@@ -66,9 +59,7 @@ def get_latest_forecasts(f, code):
             forecasts[key] = batch.ForecastedFundamentals(revenue_analysts=int(r[2]), revenue_high=float(r[3]), revenue_low=float(r[4]), revenue=float(r[5]), eps_analysts=int(r[6]), eps_high=float(r[7]), eps_low=float(r[8]), eps=float(r[9]), dps=float(r[10]))
     return forecasts
 
-def get_latest_fundamentals(f, code):
-    recs = records.get_records(f, str(code))
-    recs = [ r for r in recs if datetime.fromtimestamp(r[1]) <= ref_date ]
+def get_latest_fundamentals(recs):
     fundamentals = {}
     if len(recs) < 1:
         return {}  #
@@ -82,15 +73,10 @@ def get_latest_fundamentals(f, code):
     res[latest_period] = fundamentals[latest_period]
     return res
 
-def get_average_turnover(bars):
-    total_turnover = 0
-    for bar in bars:
-        total_turnover += bar.px_last * bar.px_volume
-    return total_turnover / len(bars)
+def get_average_turnover(foo):
+    return numpy.sum(foo.px_last * foo.px_volume) / len(foo)
 
-def get_latest_shares(f, code):
-    recs = records.get_records(f, str(code))
-    recs = [ r for r in recs if datetime.fromtimestamp(r[1]) <= ref_date ]
+def get_latest_shares(recs):
     if len(recs) < 1:
         return 0
     return float(recs[-1][2])
@@ -98,14 +84,15 @@ def get_latest_shares(f, code):
 def get_latest_exchange_rates(f):
     currencies = ["RMB", "USD"]
     res = { "HKD" : 1 }
+    all_recs = records.get_records_many(f, currencies)
     for currency in currencies:
-        recs = records.get_records(f, currency)
-        res[currency] = float(recs[-1][2])
+        res[currency] = float(all_recs[currency][-1][2])
     return res
 
-def get_corporate_action_occurrence(f, code, start_date, end_date):
-    recs = records.get_records(f, str(code))
-    recs = [ r for r in recs if datetime.strftime(datetime.fromtimestamp(r[1]), "%Y%m%d") >= start_date and datetime.strftime(datetime.fromtimestamp(r[1]), "%Y%m%d") <= end_date ]
+def get_corporate_action_occurrence(recs, start_date, end_date):
+    start_timestamp = datetime.strptime(start_date, "%Y%m%d").timestamp()
+    end_timestamp = (datetime.strptime(end_date, "%Y%m%d") + dt.timedelta(days=1)).timestamp()
+    recs = [ r for r in recs if r[1] >= start_timestamp and r[1] < end_timestamp ]
     return len(recs) > 0
 
 # Codes
@@ -133,10 +120,12 @@ industry_file = configParser.get("Main", "industry_file")
 exclude_industries = configParser.get("Sample", "exclude_industries").split(",")
 exclude_sectors = configParser.get("Sample", "exclude_sectors").split(",")
 
+industry_records = records.get_records_many(os.path.join(options.directory, industry_file), eligible_codes, as_of=ref_timestamp)
+
 toDelete = []
 for code in eligible_codes:
-    industry = get_latest_industry(os.path.join(options.directory, industry_file), code)
-    sector = get_latest_sector(os.path.join(options.directory, industry_file), code)
+    industry = get_latest_industry(industry_records[code])
+    sector = get_latest_sector(industry_records[code])
     if industry in exclude_industries or sector in exclude_sectors:
         toDelete += [code]
     else:
@@ -158,6 +147,7 @@ print(price_whitelist, file=sys.stderr)
 # Turnover / Missing Data
 
 prices_folder = configParser.get("Main", "prices_folder")
+columnar_prices_folder = configParser.get("Main", "columnar_prices_folder")
 
 dates = sorted(os.listdir(os.path.join(options.directory, prices_folder)))
 dates = [d for d in dates if d <= options.date]
@@ -174,18 +164,21 @@ foos = {}
 toDelete = []
 
 for d in dates:
-    foo = bars.read_all_bars(os.path.join(options.directory, prices_folder, d))
+    foo = bars.read_all_bars_store(os.path.join(options.directory, prices_folder, d), os.path.join(options.directory, columnar_prices_folder, d))
     for code in foo:
         if code not in price_whitelist:
             continue
         if code not in foos:
             foos[code] = []
-        foos[code] += foo[code]
+        foos[code] += [foo[code]]
     for code in price_whitelist:
         if code not in foo:
             if code not in toDelete:
                 toDelete += [code]
 
+for code in foos:
+    foos[code] = bars.concatenate_bars(foos[code])
+
 eligible_codes = [ c for c in eligible_codes if c not in toDelete ]
 
 print("Filtered for Missing Data -", file=sys.stderr)
@@ -212,9 +205,11 @@ ratings_file = configParser.get("Main", "ratings_file")
 
 min_analysts_count = int(configParser.get("Sample", "min_analysts_count"))
 
+ratings_records = records.get_records_many(os.path.join(options.directory, ratings_file), eligible_codes, as_of=ref_timestamp)
+
 toDelete = []
 for code in eligible_codes:
-    ratings = get_latest_ratings(os.path.join(options.directory, ratings_file), code)
+    ratings = get_latest_ratings(ratings_records[code])
     analysts_count = (ratings.buy_analysts + ratings.outperform_analysts + ratings.hold_analysts + ratings.underperform_analysts + ratings.sell_analysts) if ratings is not None else 0
     if analysts_count < min_analysts_count:
         toDelete += [code]
@@ -232,9 +227,11 @@ shares_file = configParser.get("Main", "shares_file")
 
 min_market_cap = float(configParser.get("Sample", "min_market_cap"))
 
+shares_records = records.get_records_many(os.path.join(options.directory, shares_file), eligible_codes, as_of=ref_timestamp)
+
 toDelete = []
 for code in eligible_codes:
-    shares = get_latest_shares(os.path.join(options.directory, shares_file), code)
+    shares = get_latest_shares(shares_records[code])
     market_cap = all_prices[code].px_last * shares
     if market_cap < min_market_cap:
         toDelete += [code]
@@ -250,9 +247,11 @@ print(eligible_codes, file=sys.stderr)
 
 corporate_actions_file = configParser.get("Main", "corporate_actions_file")
 
+corporate_actions_records = records.get_records_many(os.path.join(options.directory, corporate_actions_file), eligible_codes)
+
 toDelete = []
 for code in eligible_codes:
-    has_cacs = get_corporate_action_occurrence(os.path.join(options.directory, corporate_actions_file), code, dates[0], dates[-1])
+    has_cacs = get_corporate_action_occurrence(corporate_actions_records[code], dates[0], dates[-1])
     if has_cacs:
         toDelete += [code]
 
@@ -272,11 +271,11 @@ all_volatilities = {}
 
 max_log_volatility_diff = float(configParser.get("Sample", "max_log_volatility_diff"))
 
-for code in eligible_codes:
-    try:  # May not be able to calculate volatility
-        all_volatilities[code] = xs.get_volatility(grouped_bars[code])
-    except:
-        continue
+volatilities = xs.get_volatility_batch([ grouped_bars[code] for code in eligible_codes ]) if len(eligible_codes) > 0 else []
+
+for (code, volatility) in zip(eligible_codes, volatilities):
+    if numpy.isfinite(volatility):  # May not be able to calculate volatility
+        all_volatilities[code] = volatility
 
 eligible_pairs = []
 
@@ -298,47 +297,12 @@ print(eligible_pairs, file=sys.stderr)
 # Clean Auction and Market Open Ticks
 # Fill back morning/afternoon Ticks
 
-auction_time = datetime.strptime(bars.market_auction, "%H:%M:%S%z")
-market_am_open_time = datetime.strptime(bars.market_am_open, "%H:%M:%S%z")
-market_pm_open_time = datetime.strptime(bars.market_pm_open, "%H:%M:%S%z")
-market_am_close_time = datetime.strptime(bars.market_am_close, "%H:%M:%S%z")
-market_pm_close_time = datetime.strptime(bars.market_pm_close, "%H:%M:%S%z")
+calendar = bars.TradingCalendar(dates)
 
 for code in price_whitelist:
     if code not in foos:
         continue
-    toDelete = []
-    for i in range(0, len(foos[code])):
-        ts = datetime.fromtimestamp(foos[code][i].timestamp)
-        if (ts.hour == auction_time.hour and ts.minute == auction_time.minute) or (ts.hour == market_am_open_time.hour and ts.minute == market_am_open_time.minute) or (ts.hour == market_pm_open_time.hour and ts.minute == market_pm_open_time.minute):
-            toDelete += [i]
-    for i in sorted(toDelete, reverse=True):
-        del foos[code][i]
-    patched = []
-    for i in range(0, len(foos[code])):
-        ts = datetime.fromtimestamp(foos[code][i].timestamp)
-        last_ts = datetime.fromtimestamp(foos[code][i-1].timestamp) if i > 0 else None
-        next_ts = datetime.fromtimestamp(foos[code][i+1].timestamp) if i < len(foos[code]) - 1 else None
-        if (ts.hour == market_pm_open_time.hour and ts.minute == market_pm_open_time.minute + 1):
-            last_px = None
-            if last_ts is None:
-                last_px = foos[code][i].px_open
-            elif (last_ts.hour == market_pm_close_time.hour and last_ts.minute == market_pm_close_time.minute):
-                last_px = foos[code][i-1].px_last
-            if last_px is not None:
-                tmp_ts = datetime.combine(ts.date(), market_am_open_time.time()).timestamp()
-                while tmp_ts % 86400 < market_am_close_time.timestamp() % 86400:
-                    tmp_ts += 60
-                    patched += [bars.Bar(timestamp=tmp_ts, px_open=last_px, px_high=last_px, px_low=last_px, px_last=last_px, px_volume=0)]
-        patched += [foos[code][i]]
-        if (ts.hour == market_am_close_time.hour and ts.minute == market_am_close_time.minute):
-            if next_ts is None or (next_ts.hour == market_am_open_time.hour and next_ts.minute == market_am_open_time.minute + 1):
-                last_px = foos[code][i].px_last
-                tmp_ts = ts.timestamp() + (market_pm_open_time - market_am_close_time).seconds
-                while tmp_ts % 86400 < market_pm_close_time.timestamp() % 86400:
-                    tmp_ts += 60
-                    patched += [bars.Bar(timestamp=tmp_ts, px_open=last_px, px_high=last_px, px_low=last_px, px_last=last_px, px_volume=0)]
-    foos[code] = patched
+    foos[code] = bars.patch_bars(foos[code], calendar)
 
 # Write Output
 
@@ -350,6 +314,7 @@ except OSError:
     pass
 
 today_timestamp = datetime.combine(ref_date.date(), dt.time(0, 0)).timestamp()
+tomorrow_timestamp = datetime.combine(ref_date.date() + dt.timedelta(days=1), dt.time(0, 0)).timestamp()
 
 hdf = pandas.HDFStore(os.path.join(options.directory, experiment_folder, "data.h5"))
 
@@ -361,7 +326,7 @@ else:
 for code in price_whitelist:
     if code not in foos:
         continue
-    tmp_prices = [ b for b in foos[code] if datetime.fromtimestamp(b.timestamp).date() == ref_date.date() ]
+    tmp_prices = foos[code][(foos[code].timestamp >= today_timestamp) & (foos[code].timestamp < tomorrow_timestamp)]
     if len(tmp_prices) == 0:
         continue
     tmp_df = pandas.DataFrame(tmp_prices, columns=bars.Bar._fields, dtype=numpy.float64)
@@ -3,21 +3,31 @@
 import pyximport; pyximport.install()
 import sys
 import os
+import re
 import operator
+import itertools
+import queue
+from collections import namedtuple
 import datetime as dt
 from datetime import datetime
 from optparse import OptionParser
+from multiprocessing import shared_memory
 import configparser
 import numpy
 import pandas
 
 import features
+import transform
+import worker
+import xs
 
 parser = OptionParser()
 parser.add_option("--directory", dest="directory", help="Directory to Store Data", default="data")
 parser.add_option("--date", dest="date", help="Date (YYYYMMDD)", default=datetime.strftime(datetime.today(), "%Y%m%d"))
 parser.add_option("--config", dest="config", help="Name of Configuration File", default=None)
 parser.add_option("--experiment", dest="expt", help="Name of Experiment", default=None)
+parser.add_option("--sweep", dest="sweep", help="Also Label a Grid of Stop-loss and Pullback Ratios", action="store_true", default=False)
+parser.add_option("--jobs", dest="jobs", type="int", help="Number of Processes (each gets an equal share of denoise_cache_size)", default=1)
 (options, args) = parser.parse_args()
 
 configParser = configparser.ConfigParser()
@@ -38,33 +48,197 @@ target_min_days = int(configParser.get(options.expt, "target_min_days"))
 target_max_days = int(configParser.get(options.expt, "target_max_days"))
 
 targets = configParser.get(options.expt, "targets").split(",")
+target_plan = features.compile_targets(targets)
+target_columns = features.target_columns(target_plan)
+
+if options.sweep:
+    sweep_stop_loss_ratios = [ float(x) for x in configParser.get(options.expt, "sweep_stop_loss_ratios").split(",") ]
+    sweep_pullback_ratios = [ float(x) for x in configParser.get(options.expt, "sweep_pullback_ratios").split(",") ]
+    sweep_plan = features.compile_targets(features.sweep_targets(sweep_stop_loss_ratios, sweep_pullback_ratios))
+
+transform.denoise_cache_folder = os.path.join(options.directory, configParser.get("Main", "denoise_cache_folder"))
+# Each sample worker evicts against its own share, so together they stay within the configured size
+transform.denoise_cache_size = int(configParser.get("Main", "denoise_cache_size")) // max(options.jobs, 1)
 
 # Utility Functions
 
+# Each row of a samples table is keyed by its window and code; the table name carries the feature time and wavelet/target
+sample_key_columns = ["start_timestamp", "split_timestamp", "end_timestamp", "code"]
+
+def sample_tables(t):
+    return ["%s_%s" % (wavelet, t) for wavelet in wavelets] + ["%s_%s" % (target, t) for target in targets] + (["sweep_%s" % t] if options.sweep else [])
+
+# Rows with columns a stored table lacks (e.g. more coefficients from longer series) continue in a new version of it,
+# <table>_v2, <table>_v3, ..., since a PyTables table cannot gain columns
+def table_version(table):
+    m = re.match(r"^(.*)_v(\d+)$", table)
+    return (m.group(1), int(m.group(2))) if m else (table, 1)
+
+def add_sample_row(pending, existing_keys, table, titles, values, key):
+    if key in existing_keys.get(table, set()):
+        return
+    row = dict(zip(titles, values))
+    row.update(zip(sample_key_columns, key))
+    pending.setdefault(table, []).append(row)
+
+# A table sorted by (code, timestamp) with the row range of each code, so a window is two searchsorted calls on one code
+CodeIndex = namedtuple("CodeIndex", ["df", "timestamps", "offsets"])
+
+def index_by_code(df):
+    df = df.sort_values(["code", "timestamp"], kind="mergesort").reset_index(drop=True)
+    codes = df["code"].values
+    starts = numpy.flatnonzero(numpy.r_[True, codes[1:] != codes[:-1]]) if codes.shape[0] > 0 else numpy.array([], dtype=int)
+    ends = numpy.r_[starts[1:], codes.shape[0]]
+    return CodeIndex(df, df["timestamp"].values, dict(zip(codes[starts].tolist(), zip(starts.tolist(), ends.tolist()))))
+
+def code_window_bounds(index, code, start, end):
+    if code not in index.offsets:
+        return (0, 0)
+    (i, j) = index.offsets[code]
+    timestamps = index.timestamps[i:j]
+    return (i + numpy.searchsorted(timestamps, start, side="left"), i + numpy.searchsorted(timestamps, end, side="right"))
+
+def code_windows(index, code, start, end):
+    # Row ranges of a code's window, or of both legs of a pair code (code1 * 100000 + code2)
+    return [ code_window_bounds(index, c, start, end) for c in ([code] if code <= 99999 else [code // 100000, code % 100000]) ]
+
+def window_series(code, windows):
+    return windows[0] if len(windows) == 1 else pair_series(code, windows[0], windows[1])
+
+def pair_series(code, series1, series2):
+    # Equal-weighted pair of two codes, each normalised by its first open
+    price_series = pandas.DataFrame(None, index=series1.index, columns=series1.columns)
+    price_series["code"] = numpy.ones(series1.shape[0]) * code
+    price_series["timestamp"] = series1["timestamp"]
+    for column in ["px_open", "px_high", "px_low", "px_last"]:
+        price_series[column] = series1[column] / series1["px_open"][0] / 2 + series2[column] / series2["px_open"][0] / 2
+    price_series["px_volume"] = numpy.zeros(series1.shape[0])  #
+    return price_series
+
+# The sorted price table in one shared block: worker processes rebuild a window's DataFrame over it without pickling
+
+price_blocks = {}
+
+def share_price_table(df):
+    block = shared_memory.SharedMemory(create=True, size=max(df.shape[0] * df.shape[1] * 8, 1))
+    numpy.ndarray(df.shape, dtype=numpy.float64, buffer=block.buf)[...] = df.values
+    price_blocks[block.name] = block
+    return (block.name, df.shape, list(df.columns))
+
+def shared_price_window(descriptor, bounds):
+    (block_name, shape, columns) = descriptor
+    if block_name not in price_blocks:
+        price_blocks[block_name] = xs.attach_shared_memory(block_name)
+    table = numpy.ndarray(shape, dtype=numpy.float64, buffer=price_blocks[block_name].buf)
+    return pandas.DataFrame(table[bounds[0]:bounds[1]], columns=columns, copy=False)
+
+def release_price_table():
+    for block_name in list(price_blocks):
+        block = price_blocks.pop(block_name)
+        block.close()
+        block.unlink()
+
+# Samples
+
+# One (date window, code) each, with the price rows of the code or of both legs of a pair
+Shard = namedtuple("Shard", ["start_date", "split_date", "end_date", "start_timestamp", "split_timestamps", "end_timestamp", "code", "bounds"])
+
+def generate_sample_rows(samples, start_timestamp, split_timestamps, end_timestamp):
+    # Rows (table, titles, values, key) of each (code, price_series) sample of a date window, batched over the samples
+    splits = []
+    for (code, price_series) in samples:
+        expected_ranges = features.get_expected_ranges(price_series, split_timestamps)
+        splits += [[ features.split_series(price_series, split_timestamp, expected_range=expected_range) for (split_timestamp, expected_range) in zip(split_timestamps, expected_ranges) ]]
+    # Wavelet features for all samples at a split time, batched over the samples with the same number of bars
+    wavelet_features = [ [None] * len(feature_times) for split in splits ]
+    for i in range(0, len(feature_times)):
+        batches = {}
+        for (j, split) in enumerate(splits):
+            batches.setdefault(split[i][0].shape[0], []).append(j)
+        for js in batches.values():
+            X_batch = features.generate_wavelet_features_batch(numpy.array([ splits[j][i][0].values for j in js ], dtype=numpy.float64), wavelets, wavelet_detail_per_level, 1)
+            for (j, X) in zip(js, X_batch):
+                wavelet_features[j][i] = X.reshape((len(wavelets), -1))
+    # Targets for every sample and split time in one call
+    if len(splits) > 0:
+        (o, h, l, c, lengths) = features.stack_ohlc([ split[i][2] for split in splits for i in range(0, len(feature_times)) ])
+        (all_Y, all_Y_titles) = features.generate_targets_batch(o, h, l, c, lengths, [ split[i][1] for split in splits for i in range(0, len(feature_times)) ], target_plan)
+        if options.sweep:
+            (all_sweep, all_sweep_titles) = features.generate_targets_batch(o, h, l, c, lengths, [ split[i][1] for split in splits for i in range(0, len(feature_times)) ], sweep_plan)
+    rows = []
+    for (j, (code, price_series)) in enumerate(samples):
+        sample_rows = []
+        for (i, (t, split_timestamp)) in enumerate(zip(feature_times, split_timestamps)):
+            key = (start_timestamp, split_timestamp, end_timestamp, float(code))
+            for (w, wavelet) in enumerate(wavelets):
+                X = wavelet_features[j][i][w]
+                sample_rows += [("%s_%s" % (wavelet, t), ["coef_%d" % (k + 1) for k in range(0, X.shape[0])], X, key)]
+            for target in targets:
+                sample_rows += [("%s_%s" % (target, t), all_Y_titles[target_columns[target]], all_Y[j * len(feature_times) + i, target_columns[target]], key)]
+            if options.sweep:
+                sample_rows += [("sweep_%s" % t, all_sweep_titles, all_sweep[j * len(feature_times) + i], key)]
+        rows += [sample_rows]
+    return rows
+
+class SampleTask:
+    def __init__(self, shard_id, descriptor, shard):
+        self.shard_id = shard_id
+        self.descriptor = descriptor
+        self.shard = shard
+    def __call__(self):
+        try:
+            features.set_num_threads(1)
+            price_series = window_series(self.shard.code, [ shared_price_window(self.descriptor, bounds) for bounds in self.shard.bounds ])
+            return (self.shard_id, generate_sample_rows([(self.shard.code, price_series)], self.shard.start_timestamp, self.shard.split_timestamps, self.shard.end_timestamp)[0], None)
+        except Exception as e:
+            return (self.shard_id, None, "%s: %s" % (type(e).__name__, e))
+
 # Generate features
 
+if options.jobs > 1:
+    # Fork before any store is opened, so the workers hold no HDF5 handles
+    samplePool = worker.WorkerPool(options.jobs)
+    for w in samplePool.workers:
+        w.daemon = True
+    samplePool.start()
+
 input_hdf = pandas.HDFStore(os.path.join(options.directory, experiment_folder, "data.h5"))
 
-price_df = input_hdf["price"]
+price_index = index_by_code(input_hdf["price"])
 eligible_df = input_hdf["eligible"]
+eligible_index = index_by_code(eligible_df)
 
 output_hdf = pandas.HDFStore(os.path.join(options.directory, experiment_folder, "samples.h5"))
 
-memory = {}
+existing_keys = {}
+table_columns = {}
+pending = {}
 
 for table in output_hdf.keys():
-    if table not in memory:
-        memory[table] = output_hdf[table]
+    table = table.lstrip("/")
+    columns = output_hdf.select(table, stop=0).columns
+    if "code" not in columns:
+        # Tables written before samples carried their code cannot be keyed, and their windows would be appended again.
+        # They are set aside as <table>_legacy, rows intact, since a run only rebuilds the windows up to its --date
+        if not table.endswith("_legacy"):
+            print("Renaming %s to %s_legacy, written without codes" % (table, table), file=sys.stderr)
+            output_hdf.get_node(table)._f_rename(table + "_legacy")
+        continue
+    (base, version) = table_version(table)
+    table_columns.setdefault(base, {})[version] = set(columns)
+    existing_keys.setdefault(base, set()).update([ tuple(key) for key in output_hdf.select(table, columns=sample_key_columns).values.tolist() ])
 
 codes = eligible_df["code"].drop_duplicates()
 
-all_dates = sorted(list(set([datetime.fromtimestamp(t).date() for t in price_df["timestamp"].drop_duplicates()])))
+all_dates = sorted(list(set([datetime.fromtimestamp(t).date() for t in numpy.unique(price_index.timestamps)])))
 
 dates = [d for d in all_dates if d <= datetime.strptime(options.date, "%Y%m%d").date()]
 
 date_count = 0
 sample_count = 0
 
+shards = []
+
 while date_count < (target_max_days-target_min_days+1):
     split_date = dates[-(target_min_days+date_count)]
     end_date = max([dates[-(target_min_days+date_count-i+1)] for i in range(target_min_days, target_max_days+1)])
@@ -74,68 +248,90 @@ while date_count < (target_max_days-target_min_days+1):
     date_span = dates.index(end_date) - dates.index(start_date) + 1
     start_timestamp = datetime.combine(start_date, features.market_am_open_time.time()).timestamp()  #
     end_timestamp = datetime.combine(end_date, features.market_pm_close_time.time()).timestamp()  #
+    split_timestamps = [ datetime.combine(split_date, datetime.strptime(t, "%H:%M:%S").time()).timestamp() for t in feature_times ]
     for code in codes:
-        code_eligibility = eligible_df[(eligible_df["code"] == code) & (eligible_df["timestamp"] >= start_date_timestamp) & (eligible_df["timestamp"] <= end_date_timestamp)]
-        if code_eligibility.shape[0] < date_span:
+        if all([ (start_timestamp, split_timestamp, end_timestamp, float(code)) in existing_keys.get(table, set()) for (t, split_timestamp) in zip(feature_times, split_timestamps) for table in sample_tables(t) ]):
             continue
-        if code <= 99999:
-            price_series = price_df[(price_df["code"] == code) & (price_df["timestamp"] >= start_timestamp) & (price_df["timestamp"] <= end_timestamp)].reset_index(drop=True)
-        else:
-            code1 = code // 100000
-            code2 = code % 100000
-            tmp_series1 = price_df[(price_df["code"] == code1) & (price_df["timestamp"] >= start_timestamp) & (price_df["timestamp"] <= end_timestamp)].reset_index(drop=True)
-            tmp_series2 = price_df[(price_df["code"] == code2) & (price_df["timestamp"] >= start_timestamp) & (price_df["timestamp"] <= end_timestamp)].reset_index(drop=True)
-            p1 = tmp_series1["px_open"][0]
-            p2 = tmp_series2["px_open"][0]
-            price_series = pandas.DataFrame(None, columns=tmp_series1.columns)
-            price_series["code"] = pandas.Series(numpy.ones(tmp_series1.shape[0]) * code)
-            price_series["timestamp"] = tmp_series1["timestamp"]
-            price_series["px_open"] = tmp_series1["px_open"] / p1 / 2 + tmp_series2["px_open"] / p2 / 2
-            price_series["px_high"] = tmp_series1["px_high"] / p1 / 2 + tmp_series2["px_high"] / p2 / 2
-            price_series["px_low"] = tmp_series1["px_low"] / p1 / 2 + tmp_series2["px_low"] / p2 / 2
-            price_series["px_last"] = tmp_series1["px_last"] / p1 / 2 + tmp_series2["px_last"] / p2 / 2
-            price_series["px_volume"] = pandas.Series(numpy.zeros(tmp_series1.shape[0]))  #
-        for t in feature_times:
-            split_timestamp = datetime.combine(split_date, datetime.strptime(t, "%H:%M:%S").time()).timestamp()
-            X_series, expected_range, Y_series = features.split_series(price_series, split_timestamp)
-            for wavelet in wavelets:
-                X = features.generate_wavelet_features(X_series, wavelet, wavelet_detail_per_level, 1)
-                X_titles = ["coef_%d" % (i + 1) for i in range(0, X.shape[0])]
-                X_df = pandas.DataFrame([X], columns=X_titles, dtype=numpy.float64)
-                X_df["start_timestamp"] = start_timestamp
-                X_df["split_timestamp"] = split_timestamp
-                X_df["end_timestamp"] = end_timestamp
-                X_df_name = "%s_%s" % (wavelet, t)
-                if X_df_name not in memory:
-                    memory[X_df_name] = X_df
-                else:
-                    memory[X_df_name] = memory[X_df_name].append(X_df, ignore_index=True)
-            for target in targets:
-                Y, Y_titles = features.generate_targets(Y_series, expected_range, [target])
-                Y_df = pandas.DataFrame([Y], columns=Y_titles, dtype=numpy.float64)
-                Y_df["start_timestamp"] = start_timestamp
-                Y_df["split_timestamp"] = split_timestamp
-                Y_df["end_timestamp"] = end_timestamp
-                Y_df_name = "%s_%s" % (target, t)
-                if Y_df_name not in memory:
-                    memory[Y_df_name] = Y_df
-                else:
-                    memory[Y_df_name] = memory[Y_df_name].append(Y_df, ignore_index=True)
-        sample_count += 1
-        print("(%s, %s, %s, %d)" % (start_date, split_date, end_date, code), file=sys.stderr)
+        (i, j) = code_window_bounds(eligible_index, code, start_date_timestamp, end_date_timestamp)
+        if j - i < date_span:
+            continue
+        shards += [Shard(start_date, split_date, end_date, start_timestamp, split_timestamps, end_timestamp, code, code_windows(price_index, code, start_timestamp, end_timestamp))]
     if start_date <= dates[0]:
         break
     date_count += 1
 
 input_hdf.close()
 
-output_hdf = pandas.HDFStore(os.path.join(options.directory, experiment_folder, "samples.h5"))
+shard_rows = [None] * len(shards)
+aborted = False
+
+if options.jobs <= 1:
+    # The shards of a date window together, so wavelets and targets are batched over its codes
+    for (split_date, window) in itertools.groupby(range(0, len(shards)), key=lambda k: shards[k].split_date):
+        window = list(window)
+        shard = shards[window[0]]
+        samples = [ (shards[k].code, window_series(shards[k].code, [ price_index.df.iloc[i:j].reset_index(drop=True) for (i, j) in shards[k].bounds ])) for k in window ]
+        for (k, rows) in zip(window, generate_sample_rows(samples, shard.start_timestamp, shard.split_timestamps, shard.end_timestamp)):
+            shard_rows[k] = rows
+            print("(%s, %s, %s, %d)" % (shards[k].start_date, shards[k].split_date, shards[k].end_date, shards[k].code), file=sys.stderr)
+else:
+    descriptor = share_price_table(price_index.df)
+    try:
+        for (k, shard) in enumerate(shards):
+            samplePool.put(SampleTask(k, descriptor, shard))
+        count = 0
+        while count < len(shards):
+            try:
+                (k, rows, error) = samplePool.get(timeout=10)
+            except queue.Empty:
+                # A worker killed mid-task (segfault, OOM) never returns its shard
+                if samplePool.health_check() < options.jobs:
+                    print("Sample workers died with %d of %d shards done. Writing the completed shards." % (count, len(shards)), file=sys.stderr)
+                    aborted = True
+                    break
+                continue
+            count += 1
+            shard = shards[k]
+            if error is None:
+                shard_rows[k] = rows
+                print("(%s, %s, %s, %d) [%d/%d]" % (shard.start_date, shard.split_date, shard.end_date, shard.code, count, len(shards)), file=sys.stderr)
+            else:
+                print("(%s, %s, %s, %d) failed: %s [%d/%d]" % (shard.start_date, shard.split_date, shard.end_date, shard.code, error, count, len(shards)), file=sys.stderr)
+    except KeyboardInterrupt:
+        print("Sample Generation Interrupted.", file=sys.stderr)
+    finally:
+        samplePool.terminate(timeout=10)
+        release_price_table()
+
+# Merge in shard order, so the tables do not depend on the number of jobs
+
+for rows in shard_rows:
+    if rows is not None:
+        for (table, titles, values, key) in rows:
+            add_sample_row(pending, existing_keys, table, titles, values, key)
+        sample_count += 1
+
+# One append per table
 
-for table in memory:
-    memory[table] = memory[table].reset_index(drop=True)
-    output_hdf.put(table, memory[table], format="table", data_columns=True)
+for table in pending:
+    df = pandas.DataFrame(pending[table])
+    versions = table_columns.get(table, {})
+    fitting = [ version for version in versions if set(df.columns) <= versions[version] ]
+    if len(fitting) > 0:
+        version = max(fitting)
+        stored_table = table if version == 1 else "%s_v%d" % (table, version)
+        df = df.reindex(columns=output_hdf.select(stored_table, stop=0).columns)
+        df.index = pandas.RangeIndex(output_hdf.get_storer(stored_table).nrows, output_hdf.get_storer(stored_table).nrows + df.shape[0])
+    else:
+        version = max(versions) + 1 if len(versions) > 0 else 1
+        stored_table = table if version == 1 else "%s_v%d" % (table, version)
+        if version > 1:
+            print("New columns for %s, continuing in %s" % (table, stored_table), file=sys.stderr)
+    output_hdf.append(stored_table, df.astype(numpy.float64), format="table", data_columns=True)
 
 output_hdf.close()
 
 print("%d samples added to %s." % (sample_count, os.path.join(options.directory, experiment_folder, "samples.h5")), file=sys.stderr)
 
+if aborted:
+    sys.exit(1)
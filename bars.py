@@ -3,6 +3,7 @@
 import sys
 import os
 import math
+import datetime as dtime
 from datetime import datetime
 from collections import namedtuple
 from enum import Enum
@@ -24,8 +25,29 @@ Bar = namedtuple("Bar", ["timestamp", "px_open", "px_high", "px_low", "px_last",
 Tick = namedtuple("Tick", ["timestamp", "px_last", "px_volume"])
 CorporateAction = namedtuple("CorporateAction", ["timestamp", "action_type", "rights_ratio", "rights_price", "dividend_amount", "exchange_rate"])
 
+# Struct-of-arrays bar series: bar_array.px_open is a float64 array, bar_array[i] is a record with the Bar fields
+bar_dtype = numpy.dtype([(field, numpy.float64) for field in Bar._fields])
+
+class BarArray(numpy.recarray):
+    pass
+
 # Utility Functions
 
+def to_bar_array(bars):
+    if isinstance(bars, BarArray):
+        return bars
+    if isinstance(bars, numpy.ndarray) and bars.dtype == bar_dtype:
+        return bars.view(BarArray)
+    return numpy.array([tuple(bar) for bar in bars], dtype=bar_dtype).view(BarArray)
+
+def concatenate_bars(bar_arrays):
+    if len(bar_arrays) < 1:
+        return to_bar_array([])
+    return numpy.concatenate([to_bar_array(bars) for bars in bar_arrays]).view(BarArray)
+
+def to_bars(bar_array):
+    return list(map(Bar._make, to_bar_array(bar_array).tolist()))
+
 # Time Calculations
 
 market_am_open_ts = datetime.strptime(market_am_open, "%H:%M:%S%z").timestamp() % 86400
@@ -80,13 +102,71 @@ def diff_bars(t1, t2, timeframe=Timeframe.ONE_MINUTE):
         add_ts = (1e-6 if t1.timestamp() % 86400 in [market_am_open_ts, market_pm_open_ts] else 0)
         return (t1.timestamp() - 1e-6 + add_ts) // timeframe.value != (t2.timestamp() - 1e-6) // timeframe.value
 
+# Trading Calendar
+# Session boundaries are held as seconds from the exchange's local midnight, so
+# the per-bar conversions are array arithmetic and lookups instead of datetimes.
+
+def session_seconds(t):
+    t = datetime.strptime(t, "%H:%M:%S%z")
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+class TradingCalendar(object):
+    def __init__(self, dates=[], auction=market_auction, am_open=market_am_open, am_close=market_am_close, pm_open=market_pm_open, pm_close=market_pm_close):
+        self.dates = sorted([ d if isinstance(d, dtime.date) else datetime.strptime(d, "%Y%m%d").date() for d in dates ])
+        self.utc_offset = datetime.strptime(am_open, "%H:%M:%S%z").utcoffset().total_seconds()
+        self.auction = session_seconds(auction)
+        self.am_open = session_seconds(am_open)
+        self.am_close = session_seconds(am_close)
+        self.pm_open = session_seconds(pm_open)
+        self.pm_close = session_seconds(pm_close)
+        self.day_starts = numpy.array([ datetime.combine(d, dtime.time(0, 0), tzinfo=dtime.timezone.utc).timestamp() - self.utc_offset for d in self.dates ], dtype=numpy.float64)
+        # Minute of day -> minutes since the open, not counting the lunch break
+        day_minutes = numpy.arange(0, 1440) * 60
+        self.minute_index = (numpy.where(day_minutes >= self.pm_open, day_minutes - (self.pm_open - self.am_close), day_minutes) - self.am_open) // 60
+    def day_seconds(self, timestamps):
+        return (numpy.asarray(timestamps, dtype=numpy.float64) + self.utc_offset) % 86400
+    def session_id(self, timestamps):
+        timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+        i = numpy.searchsorted(self.day_starts, timestamps, side='right') - 1
+        valid = (i >= 0) & (timestamps < self.day_starts[numpy.maximum(i, 0)] + 86400) if len(self.dates) > 0 else numpy.zeros(timestamps.shape, dtype=bool)
+        return numpy.where(valid, i, -1)
+    def time_since_open(self, timestamps):
+        ts = self.day_seconds(timestamps)
+        return numpy.where(ts >= self.pm_open, ts - (self.pm_open - self.am_close), ts) - self.am_open
+    def minute_of_session(self, timestamps):
+        return self.minute_index[(self.day_seconds(timestamps) // 60).astype(numpy.int64)]
+    def is_am(self, timestamps):
+        ts = self.day_seconds(timestamps)
+        return (ts >= self.am_open) & (ts < self.am_close)
+
+def local_days(timestamps):
+    # Local calendar day of each timestamp, as datetime.fromtimestamp(t).date() would give
+    timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+    (hours, inverse) = numpy.unique(timestamps // 3600, return_inverse=True)
+    offsets = numpy.array([ datetime.fromtimestamp(h * 3600).astimezone().utcoffset().total_seconds() for h in hours.tolist() ])
+    return ((timestamps + offsets[inverse.reshape(-1)]) // 86400).astype(numpy.int64)
+
+def bucket_ids(timestamps, timeframe=Timeframe.ONE_MINUTE):
+    # Returns (days, first_buckets, last_buckets): diff_bars(t1, t2) is False iff t1, t2 share a day and first_buckets[t1] == last_buckets[t2]
+    timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+    days = local_days(timestamps)
+    if timeframe == Timeframe.DAILY:
+        buckets = numpy.zeros(timestamps.shape[0])
+        return (days, buckets, buckets)
+    ts = timestamps % 86400
+    if timeframe == Timeframe.AM_PM:
+        buckets = 1.0 * ((ts >= market_am_open_ts) & (ts < market_am_close_ts))
+        return (days, buckets, buckets)
+    add_ts = numpy.where((ts == market_am_open_ts) | (ts == market_pm_open_ts), 1e-6, 0)
+    return (days, (timestamps - 1e-6 + add_ts) // timeframe.value, (timestamps - 1e-6) // timeframe.value)
+
 # Corporate Actions
 
 def read_corporate_actions(filename, code):
     code = int(code)
     corporate_actions = []
     with open(filename, 'r') as f:
-        all_linea = f.read()
+        all_lines = f.read()
     lines = all_lines.split("\n")
     for line in lines:
         try:
@@ -104,6 +184,79 @@ def read_corporate_actions(filename, code):
             continue
     return sorted(corporate_actions, key=lambda x: x.timestamp)
 
+# Adjustments
+# Applying the actions newest first, each bar's adjusted price is an affine map
+# price * factor + offset of its raw price, fixed by the actions after the bar.
+# adjustment_table computes one (factor, offset, volume factor) per suffix of the
+# sorted actions in O(actions * log bars), less than a lookup keyed on the prices.
+
+def adjustment_table(timestamps, px_last, corporate_actions):
+    actions = sorted(corporate_actions, key=lambda x: x.timestamp)
+    m = len(actions)
+    action_timestamps = numpy.array([action.timestamp for action in actions], dtype=numpy.float64)
+    price_factors = numpy.ones(m + 1)
+    price_offsets = numpy.zeros(m + 1)
+    volume_factors = numpy.ones(m + 1)
+    for k in range(m - 1, -1, -1):
+        (price_factor, price_offset, volume_factor) = (price_factors[k+1], price_offsets[k+1], volume_factors[k+1])
+        corporate_action = actions[k]
+        if corporate_action.action_type in ['D', 'SD']:
+            div_amount = corporate_action.dividend_amount * corporate_action.exchange_rate
+            if not math.isnan(div_amount):
+                price_offset -= div_amount
+        elif corporate_action.action_type in ['B', 'C', 'S', 'R']:
+            i = numpy.searchsorted(timestamps, corporate_action.timestamp, side='left') - 1
+            if not (math.isnan(corporate_action.rights_ratio) or math.isnan(corporate_action.rights_price)) and i >= 0:
+                px = px_last[i] * price_factor + price_offset
+                paf = (px + (corporate_action.rights_ratio - 1) * (corporate_action.rights_price)) / (corporate_action.rights_ratio * px)
+                price_factor *= paf
+                price_offset *= paf
+                volume_factor /= paf
+        (price_factors[k], price_offsets[k], volume_factors[k]) = (price_factor, price_offset, volume_factor)
+    return (action_timestamps, price_factors, price_offsets, volume_factors)
+
+def get_adjustments(timestamps, px_last, corporate_actions, table=None):
+    (action_timestamps, price_factors, price_offsets, volume_factors) = adjustment_table(timestamps, px_last, corporate_actions) if table is None else table
+    i = numpy.searchsorted(action_timestamps, timestamps, side='right')
+    return (price_factors[i], price_offsets[i], volume_factors[i])
+
+# Adjustment cache
+# Per (corporate actions file, code), the actions read from the file and the tables built from them, kept while the
+# file's size and mtime are those read, as records.load_index checks its index. A table depends on the bars only through
+# the last price before each rights issue, so within a version the tables are keyed on those prices.
+
+adjustment_cache = {}
+adjustment_cache_size = 1024
+adjustment_tables_per_code = 8
+
+def load_corporate_actions(filename, code):
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+    key = (path, int(code))
+    entry = adjustment_cache.pop(key, None)
+    if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+        entry = { "size" : stat.st_size, "mtime" : stat.st_mtime_ns, "actions" : read_corporate_actions(path, code), "tables" : {} }
+    if len(adjustment_cache) >= adjustment_cache_size:
+        del adjustment_cache[next(iter(adjustment_cache))]
+    adjustment_cache[key] = entry
+    return entry
+
+def rights_prices(timestamps, px_last, corporate_actions):
+    rights = [ action.timestamp for action in corporate_actions if action.action_type in ['B', 'C', 'S', 'R'] ]
+    i = numpy.searchsorted(timestamps, numpy.array(rights, dtype=numpy.float64), side='left') - 1
+    return (i >= 0).tobytes() + numpy.where(i >= 0, numpy.asarray(px_last, dtype=numpy.float64)[numpy.maximum(i, 0)] if len(px_last) > 0 else numpy.nan, 0.0).tobytes()
+
+def cached_adjustment_table(timestamps, px_last, filename, code):
+    entry = load_corporate_actions(filename, code)
+    key = rights_prices(timestamps, px_last, entry["actions"])
+    table = entry["tables"].pop(key, None)
+    if table is None:
+        table = adjustment_table(timestamps, px_last, entry["actions"])
+        if len(entry["tables"]) >= adjustment_tables_per_code:
+            del entry["tables"][next(iter(entry["tables"]))]
+    entry["tables"][key] = table
+    return (entry["actions"], table)
+
 # Bars
 
 def read_bars(filename, code):
@@ -127,7 +280,7 @@ def read_bars(filename, code):
             bars += [Bar(timestamp=timestamp, px_open=px_open, px_high=px_high, px_low=px_low, px_last=px_last, px_volume=px_volume)]
         except ValueError:
             continue
-    return sorted(bars, key=lambda x: x.timestamp)
+    return to_bar_array(sorted(bars, key=lambda x: x.timestamp))
 
 def read_all_bars(filename):
     bars = {}
@@ -150,71 +303,143 @@ def read_all_bars(filename):
         except ValueError:
             continue
     for code in bars:
-        bars[code] = sorted(bars[code], key=lambda x: x.timestamp)
+        bars[code] = to_bar_array(sorted(bars[code], key=lambda x: x.timestamp))
     return bars
 
-def adjust_bars(bars, corporate_actions=None):
-    adjusted_bars = list(bars)
+# Columnar Bars
+# Each day is stored as <filename>.npy, a (6, n) float64 array holding the Bar
+# fields as contiguous rows, and <filename>.codes.npy, an int64 array of
+# (code, start, end) column offsets. Columns are memory-mapped on read.
+
+def write_columnar_bars(filename, all_bars):
+    codes = sorted(all_bars.keys())
+    columns = numpy.empty((len(Bar._fields), sum([len(all_bars[code]) for code in codes])), dtype=numpy.float64)
+    index = numpy.empty((len(codes), 3), dtype=numpy.int64)
+    offset = 0
+    for i in range(0, len(codes)):
+        bar_array = to_bar_array(all_bars[codes[i]])
+        n = len(bar_array)
+        for j in range(0, len(Bar._fields)):
+            columns[j, offset:offset+n] = bar_array[Bar._fields[j]]
+        index[i] = (codes[i], offset, offset + n)
+        offset += n
+    try:
+        os.makedirs(os.path.dirname(os.path.realpath(filename)))
+    except FileExistsError:
+        pass
+    for (suffix, arr) in [(".npy", columns), (".codes.npy", index)]:
+        with open(filename + suffix + ".tmp", 'wb') as f:
+            numpy.save(f, arr)
+        os.replace(filename + suffix + ".tmp", filename + suffix)
+
+def convert_bars(filename, columnar_filename):
+    write_columnar_bars(columnar_filename, read_all_bars(filename))
+
+def read_columnar_bars(filename):
+    index = numpy.load(filename + ".codes.npy")
+    columns = numpy.load(filename + ".npy", mmap_mode='r')
+    return (index, columns)
+
+def read_all_bars_columnar(filename):
+    (index, columns) = read_columnar_bars(filename)
+    bars = {}
+    for (code, start, end) in index.tolist():
+        bars[code] = numpy.empty(end - start, dtype=bar_dtype).view(BarArray)
+        for j in range(0, len(Bar._fields)):
+            bars[code][Bar._fields[j]] = columns[j, start:end]
+    return bars
+
+def read_all_bars_store(filename, columnar_filename):
+    # Use the columnar copy if it is at least as new as the CSV, else convert
+    try:
+        if os.path.getmtime(columnar_filename + ".codes.npy") >= os.path.getmtime(filename):
+            return read_all_bars_columnar(columnar_filename)
+    except OSError:
+        pass
+    bars = read_all_bars(filename)
+    try:
+        write_columnar_bars(columnar_filename, bars)
+    except OSError:
+        pass
+    return bars
+
+def adjust_bars(bars, corporate_actions=None, corporate_actions_file=None, code=None):
+    # Given corporate_actions_file and code instead of the actions, they and their table come through the adjustment cache
+    adjusted_bars = to_bar_array(bars).copy()
+    table = None
+    if corporate_actions_file is not None:
+        (corporate_actions, table) = cached_adjustment_table(adjusted_bars.timestamp, adjusted_bars.px_last, corporate_actions_file, code)
     if not corporate_actions:
         return adjusted_bars
-    for corporate_action in corporate_actions[::-1]:
-        if corporate_action.action_type in ['D', 'SD']:
-            div_amount = corporate_action.dividend_amount * corporate_action.exchange_rate
-            if math.isnan(div_amount):
-                continue
-            for i in range(0, len(adjusted_bars)):
-                if adjusted_bars[i].timestamp < corporate_action.timestamp:
-                    new_bar = Bar(timestamp=adjusted_bars[i].timestamp, px_open=adjusted_bars[i].px_open-div_amount, px_high=adjusted_bars[i].px_high-div_amount, px_low=adjusted_bars[i].px_low-div_amount, px_last=adjusted_bars[i].px_last-div_amount, px_volume=adjusted_bars[i].px_volume)
-                    adjusted_bars[i] = new_bar
-        elif corporate_action.action_type in ['B', 'C', 'S', 'R']:
-            if math.isnan(corporate_action.rights_ratio) or math.isnan(corporate_action.rights_price):
-                continue
-            paf = None
-            for i in range(0, len(adjusted_bars))[::-1]:
-                if adjusted_bars[i].timestamp < corporate_action.timestamp:
-                    if not paf:
-                        paf = (adjusted_bars[i].px_last + (corporate_action.rights_ratio - 1) * (corporate_action.rights_price)) / (corporate_action.rights_ratio * adjusted_bars[i].px_last)
-                    new_bar = Bar(timestamp=adjusted_bars[i].timestamp, px_open=adjusted_bars[i].px_open*paf, px_high=adjusted_bars[i].px_high*paf, px_low=adjusted_bars[i].px_low*paf, px_last=adjusted_bars[i].px_last*paf, px_volume=adjusted_bars[i].px_volume/paf)
-                    adjusted_bars[i] = new_bar
+    (price_factors, price_offsets, volume_factors) = get_adjustments(adjusted_bars.timestamp, adjusted_bars.px_last, corporate_actions, table=table)
+    for field in ["px_open", "px_high", "px_low", "px_last"]:
+        adjusted_bars[field] = adjusted_bars[field] * price_factors + price_offsets
+    adjusted_bars.px_volume = adjusted_bars.px_volume * volume_factors
     return adjusted_bars
 
 def join_bars(bars):
-    start_timestamp = (1 << 31)
-    timestamp = -(1 << 31)
-    px_open = None
-    px_high = 0
-    px_low = 1e9
-    px_last = None
-    px_volume = 0
-    for bar in bars:
-        if bar.timestamp < start_timestamp:
-            start_timestamp = bar.timestamp
-            px_open = bar.px_open
-        if bar.timestamp > timestamp:
-            timestamp = bar.timestamp
-            px_last = bar.px_last
-        if bar.px_high > px_high:
-            px_high = bar.px_high
-        if bar.px_low < px_low:
-            px_low = bar.px_low
-        px_volume += bar.px_volume
-    return Bar(timestamp=timestamp, px_open=px_open, px_high=px_high, px_low=px_low, px_last=px_last, px_volume=px_volume)
+    bars = to_bar_array(bars)
+    if len(bars) < 1:
+        return Bar(timestamp=-(1 << 31), px_open=None, px_high=0, px_low=1e9, px_last=None, px_volume=0)
+    return Bar(timestamp=float(numpy.max(bars.timestamp)), px_open=float(bars.px_open[numpy.argmin(bars.timestamp)]), px_high=max(float(numpy.max(bars.px_high)), 0), px_low=min(float(numpy.min(bars.px_low)), 1e9), px_last=float(bars.px_last[numpy.argmax(bars.timestamp)]), px_volume=float(numpy.sum(bars.px_volume)))
 
 def group_bars(bars=[], timeframe=Timeframe.ONE_MINUTE):
-    grouped_bars = []
-    foo = []
-    for bar in bars[::-1]:
-        if len(foo) > 0:
-            if diff_bars(bar.timestamp, foo[-1].timestamp, timeframe=timeframe):
-                joined_bar = join_bars(foo)
-                grouped_bars = [joined_bar] + grouped_bars
-                foo = []
-        foo = [bar] + foo
-    if len(foo) > 0:
-        joined_bar = join_bars(foo)
-        grouped_bars = [joined_bar] + grouped_bars
+    # Vectorized equivalent of joining runs of sorted bars for which diff_bars(bar, last bar of run) is False
+    bars = to_bar_array(bars)
+    n = len(bars)
+    if n < 1:
+        return to_bar_array([])
+    (days, first_buckets, last_buckets) = bucket_ids(bars.timestamp, timeframe=timeframe)
+    same_day = days[:-1] == days[1:]
+    breaks = ~(same_day & (first_buckets[:-1] == first_buckets[1:]))
+    # Where a bar's buckets differ (market open), the comparison depends on whether it ends its group
+    for i in numpy.nonzero(first_buckets[1:] != last_buckets[1:])[0][::-1]:
+        if i + 1 == n - 1 or breaks[i + 1]:
+            breaks[i] = not (same_day[i] and first_buckets[i] == last_buckets[i + 1])
+    starts = numpy.concatenate(([0], numpy.nonzero(breaks)[0] + 1))
+    ends = numpy.concatenate((starts[1:], [n]))
+    grouped_bars = numpy.empty(len(starts), dtype=bar_dtype).view(BarArray)
+    grouped_bars.timestamp = bars.timestamp[ends - 1]
+    grouped_bars.px_open = bars.px_open[starts]
+    grouped_bars.px_high = numpy.fmax(numpy.fmax.reduceat(bars.px_high, starts), 0)
+    grouped_bars.px_low = numpy.fmin(numpy.fmin.reduceat(bars.px_low, starts), 1e9)
+    grouped_bars.px_last = bars.px_last[numpy.maximum(numpy.searchsorted(bars.timestamp, bars.timestamp[ends - 1], side='left'), starts)]
+    grouped_bars.px_volume = numpy.add.reduceat(bars.px_volume, starts)
     return grouped_bars
 
+def flat_bars(timestamps, px):
+    flat = numpy.empty(len(timestamps), dtype=bar_dtype).view(BarArray)
+    flat.timestamp = timestamps
+    for field in ["px_open", "px_high", "px_low", "px_last"]:
+        flat[field] = px
+    flat.px_volume = 0
+    return flat
+
+def patch_bars(bars, calendar):
+    # Drop auction and session-open bars, then fill a missing morning / afternoon session with flat bars at the last price
+    bars = to_bar_array(bars)
+    bars = bars[~numpy.isin(calendar.day_seconds(bars.timestamp) // 60, [calendar.auction // 60, calendar.am_open // 60, calendar.pm_open // 60])]
+    n = len(bars)
+    if n < 1:
+        return bars
+    seconds = calendar.day_seconds(bars.timestamp)
+    minutes = seconds // 60
+    day_starts = bars.timestamp - seconds
+    am_fills = numpy.nonzero((minutes == calendar.pm_open // 60 + 1) & numpy.concatenate(([True], minutes[:-1] == calendar.pm_close // 60)))[0]
+    pm_fills = numpy.nonzero((minutes == calendar.am_close // 60) & numpy.concatenate((minutes[1:] == calendar.am_open // 60 + 1, [True])))[0]
+    am_seconds = numpy.arange(calendar.am_open + 60, calendar.am_close + 1, 60)
+    pm_seconds = numpy.arange(calendar.pm_open + 60, calendar.pm_close + 1, 60)
+    # (position, order, fill): afternoon fills after bar i come before morning fills ahead of bar i + 1
+    fills = [ (i + 1, 0, flat_bars(day_starts[i] + pm_seconds, bars.px_last[i])) for i in pm_fills.tolist() ]
+    fills += [ (i, 1, flat_bars(day_starts[i] + am_seconds, bars.px_open[0] if i == 0 else bars.px_last[i-1])) for i in am_fills.tolist() ]
+    pieces = []
+    start = 0
+    for (position, order, fill) in sorted(fills, key=lambda x: x[0:2]):
+        pieces += [bars[start:position], fill]
+        start = position
+    pieces += [bars[start:]]
+    return concatenate_bars(pieces)
+
 # Ticks to Bars
 
 def read_ticks(filename, code):
@@ -237,30 +462,18 @@ def read_ticks(filename, code):
             continue
     return sorted(ticks, key=lambda x: x.timestamp)
 
-def adjust_ticks(ticks=[], corporate_actions=None):
+def adjust_ticks(ticks=[], corporate_actions=None, corporate_actions_file=None, code=None):
     adjusted_ticks = list(ticks)
-    if not corporate_actions:
+    if not (corporate_actions or corporate_actions_file is not None) or not adjusted_ticks:
         return adjusted_ticks
-    for corporate_action in corporate_actions[::-1]:
-        if corporate_action.action_type in ['D', 'SD']:
-            div_amount = corporate_action.dividend_amount * corporate_action.exchange_rate
-            if math.isnan(div_amount):
-                continue
-            for i in range(0, len(adjusted_ticks)):
-                if adjusted_ticks[i].timestamp < corporate_action.timestamp:
-                    new_tick = Tick(timestamp=adjusted_ticks[i].timestamp, px_last=adjusted_ticks[i].px_last-div_amount, px_volume=adjusted_ticks[i].px_volume)
-                    adjusted_ticks[i] = new_tick
-        elif corporate_action.action_type in ['B', 'C', 'S', 'R']:
-            if math.isnan(corporate_action.rights_ratio) or math.isnan(corporate_action.rights_price):
-                continue
-            paf = None
-            for i in range(0, len(adjusted_ticks))[::-1]:
-                if adjusted_ticks[i].timestamp < corporate_action.timestamp:
-                    if not paf:
-                        paf = (adjusted_ticks[i].px_last + (corporate_action.rights_ratio - 1) * (corporate_action.rights_price)) / (corporate_action.rights_ratio * adjusted_ticks[i].px_last)
-                    new_tick = Tick(timestamp=adjusted_ticks[i].timestamp, px_last=adjusted_ticks[i].px_last*paf, px_volume=adjusted_ticks[i].px_volume/paf)
-                    adjusted_ticks[i] = new_tick
-    return adjusted_ticks
+    timestamps = numpy.array([tick.timestamp for tick in adjusted_ticks], dtype=numpy.float64)
+    px_last = numpy.array([tick.px_last for tick in adjusted_ticks], dtype=numpy.float64)
+    px_volume = numpy.array([tick.px_volume for tick in adjusted_ticks], dtype=numpy.float64)
+    table = None
+    if corporate_actions_file is not None:
+        (corporate_actions, table) = cached_adjustment_table(timestamps, px_last, corporate_actions_file, code)
+    (price_factors, price_offsets, volume_factors) = get_adjustments(timestamps, px_last, corporate_actions, table=table)
+    return list(map(Tick._make, zip(timestamps.tolist(), (px_last * price_factors + price_offsets).tolist(), (px_volume * volume_factors).tolist())))
 
 def add_tick(bar=None, tick=None):
     if not tick:
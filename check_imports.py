@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import subprocess
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option("--modules", dest="modules", help="Modules to Check (Comma-separated)", default="bars,records,xs,transform,features")
+parser.add_option("--budget", dest="budget", help="Import Time Budget per Module (Seconds)", default="0.5")
+(options, args) = parser.parse_args()
+
+# Import each module in a fresh interpreter and compare its cumulative import time against the budget. Cython modules
+# (a .pyx beside this script) load through pyximport as the scripts do, once beforehand so the build is not counted.
+# The Cython and setuptools imports pyximport makes to check for a rebuild are reported apart and not budgeted
+
+build_packages = ["Cython", "setuptools", "pkg_resources", "pyximport", "distutils"]
+
+budget = float(options.budget)
+over_budget = []
+
+for module in options.modules.split(","):
+    statement = "import %s" % module
+    if os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), module + ".pyx")):
+        statement = "import pyximport; pyximport.install(); " + statement
+        subprocess.run([sys.executable, "-c", statement], capture_output=True, text=True)
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True)
+    if output.returncode != 0:
+        print("%s failed to import:\n%s" % (module, output.stderr), file=sys.stderr)
+        over_budget += [module]
+        continue
+    lines = [ line.split("|") for line in output.stderr.splitlines() if line.startswith("import time:") ]
+    k = [ i for (i, line) in enumerate(lines) if line[2].strip() == module ][-1]
+    depth = len(lines[k][2]) - len(lines[k][2].lstrip())
+    build = 0
+    for line in reversed(lines[:k]):
+        indent = len(line[2]) - len(line[2].lstrip())
+        if indent <= depth:
+            break
+        if indent == depth + 2 and line[2].strip().split(".")[0] in build_packages:
+            build += int(line[1])
+    seconds = (int(lines[k][1]) - build) / 1e6
+    print("%s: %.3fs" % (module, seconds) + (" (+%.3fs pyximport rebuild check)" % (build / 1e6) if build > 0 else ""), file=sys.stderr)
+    if seconds > budget:
+        over_budget += [module]
+
+if len(over_budget) > 0:
+    print("Over the %.3fs import budget: %s" % (budget, ", ".join(over_budget)), file=sys.stderr)
+    sys.exit(1)
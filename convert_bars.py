@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+import sys
+import os
+from datetime import datetime
+from optparse import OptionParser
+import configparser
+
+import bars
+
+parser = OptionParser()
+parser.add_option("--directory", dest="directory", help="Directory to Store Data", default="data")
+parser.add_option("--start", dest="start", help="Date (YYYYMMDD)", default="00000000")
+parser.add_option("--end", dest="end", help="Date (YYYYMMDD)", default=datetime.strftime(datetime.today(), "%Y%m%d"))
+parser.add_option("--config", dest="config", help="Name of Configuration File", default=None)
+(options, args) = parser.parse_args()
+
+configParser = configparser.ConfigParser()
+configParser.read(options.config)
+
+# Convert per-day price CSVs to the columnar store
+
+prices_folder = configParser.get("Main", "prices_folder")
+columnar_prices_folder = configParser.get("Main", "columnar_prices_folder")
+
+dates = sorted(os.listdir(os.path.join(options.directory, prices_folder)))
+dates = [d for d in dates if d >= options.start and d <= options.end]
+
+for d in dates:
+    bars.convert_bars(os.path.join(options.directory, prices_folder, d), os.path.join(options.directory, columnar_prices_folder, d))
+    print("Converted prices for %s." % d, file=sys.stderr)
+
+print("%d days converted to %s." % (len(dates), os.path.join(options.directory, columnar_prices_folder)), file=sys.stderr)
@@ -86,7 +86,9 @@ class Task:
 
 data_feed_threads = int(configParser.get("Data Feed", "data_feed_threads"))
 
-pool = worker.WorkerPool(data_feed_threads)
+data_feed_backend = worker.Backend(configParser.get("Data Feed", "data_feed_backend").upper())
+
+pool = worker.WorkerPool(data_feed_threads, backend=data_feed_backend)
 
 # Start
 
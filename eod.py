@@ -15,7 +15,12 @@ parser = OptionParser()
 parser.add_option("--directory", dest="directory", help="Directory to Store Data", default="data")
 parser.add_option("--date", dest="date", help="Date (YYYYMMDD)", default=datetime.strftime(datetime.today(), "%Y%m%d"))
 parser.add_option("--config", dest="config", help="Name of Configuration File", default=None)
-parser.add_option("--workers", dest="workers", type="int", help="Number of Processes", default=50)
+parser.add_option("--workers", dest="workers", type="int", help="Number of Concurrent Requests", default=50)
+parser.add_option("--backend", dest="backend", type="choice", choices=["process", "thread", "asyncio"], help="Worker Backend (process, thread or asyncio)", default="thread")
+parser.add_option("--max-attempts", dest="max_attempts", type="int", help="Attempts per Code before Giving Up", default=5)
+parser.add_option("--retry-delay", dest="retry_delay", type="float", help="Initial Retry Delay (Seconds)", default=1.0)
+parser.add_option("--max-retry-delay", dest="max_retry_delay", type="float", help="Maximum Retry Delay (Seconds)", default=60.0)
+parser.add_option("--host-rate", dest="host_rate", type="float", help="Maximum Requests per Second per Host", default=10.0)
 (options, args) = parser.parse_args()
 
 configParser = configparser.ConfigParser()
@@ -29,6 +34,29 @@ try:
 except OSError:
     pass
 
+# Workers
+# Each stage gives up on a code after --max-attempts and appends it to the day's dead letter file
+
+dead_letters_folder = configParser.get("Main", "dead_letters_folder")
+
+def create_pool():
+    return worker.RetryPool(worker.WorkerPool(options.workers, backend=worker.Backend(options.backend.upper())), max_attempts=options.max_attempts, base_delay=options.retry_delay, max_delay=options.max_retry_delay, host_rate=options.host_rate)
+
+def write_dead_letters(stage, dead_letters):
+    if dead_letters:
+        try:
+            os.makedirs(os.path.join(options.directory, dead_letters_folder))
+        except OSError:
+            pass
+        filename = os.path.join(options.directory, dead_letters_folder, options.date)
+        exists = os.path.exists(filename)
+        with open(filename, 'a') as f:
+            if not exists:
+                print("stage,code,attempts", file=f)
+            for (code, attempts) in dead_letters:
+                print("%s,%s,%d" % (stage, code, attempts), file=f)
+        print("Gave up %s for %d codes: %s" % (stage, len(dead_letters), ",".join([ str(code) for (code, attempts) in dead_letters ])), file=sys.stderr)
+
 # Exchange Rates
 
 exchange_rates_file = configParser.get("Main", "exchange_rates_file")
@@ -70,11 +98,11 @@ class PriceTask:
 prices = {}
 
 try:
-    pricePool = worker.WorkerPool(options.workers)
+    pricePool = create_pool()
     pricePool.start()
     count = 0
     for code in data_whitelist:
-        pricePool.put(PriceTask(code))
+        pricePool.put(PriceTask(code), code, host="www.google.com")
     while count < len(data_whitelist):
         try:
             result = pricePool.get(timeout=1)
@@ -83,8 +111,11 @@ try:
         if result:
             (code, intraday_data) = result
             if not intraday_data:
-                pricePool.put(PriceTask(code))
-                print("Retrying prices for %d ..." % code, file=sys.stderr)
+                if pricePool.retry(code):
+                    print("Retrying prices for %d ..." % code, file=sys.stderr)
+                else:
+                    count += 1
+                    print("Giving up prices for %d." % code, file=sys.stderr)
             else:
                 prices[code] = intraday_data
                 count += 1
@@ -94,8 +125,10 @@ except KeyboardInterrupt:
 finally:
     pricePool.terminate()
 
+write_dead_letters("prices", pricePool.dead_letters)
+
 checkDate = datetime.strptime(options.date, "%Y%m%d").date()
-for code in data_whitelist:
+for code in prices:
     toDelete = []
     for timestamp in prices[code].keys():
         if datetime.fromtimestamp(timestamp).date() != checkDate:
@@ -104,7 +137,7 @@ for code in data_whitelist:
         del prices[code][t]
 
 toDelete = []
-for code in data_whitelist:
+for code in prices:
     if not prices[code]:
         toDelete += [code]
 for c in toDelete:
@@ -148,11 +181,11 @@ class IndexTask:
 indices = {}
 
 try:
-    indexPool = worker.WorkerPool(options.workers)
+    indexPool = create_pool()
     indexPool.start()
     count = 0
     for code in index_whitelist:
-        indexPool.put(IndexTask(code))
+        indexPool.put(IndexTask(code), code, host="finance.yahoo.com")
     while count < len(index_whitelist):
         try:
             result = indexPool.get(timeout=1)
@@ -161,7 +194,9 @@ try:
         if result:
             (code, index_data) = result
             if index_data is None:
-                indexPool.put(IndexTask(code))
+                if not indexPool.retry(code):
+                    count += 1
+                    print("Giving up index for %s." % code, file=sys.stderr)
             else:
                 indices[code] = index_data
                 count += 1
@@ -170,6 +205,8 @@ except KeyboardInterrupt:
 finally:
     indexPool.terminate()
 
+write_dead_letters("indices", indexPool.dead_letters)
+
 toDelete = []
 for c in indices:
     if not indices[c]:
@@ -216,11 +253,11 @@ class BrokerActivityTask:
 broker_activities = {}
 
 try:
-    brokerActivityPool = worker.WorkerPool(options.workers)
+    brokerActivityPool = create_pool()
     brokerActivityPool.start()
     count = 0
     for code in data_whitelist:
-        brokerActivityPool.put(BrokerActivityTask(code))
+        brokerActivityPool.put(BrokerActivityTask(code), code, host="data.tsci.com.cn")
     while count < len(data_whitelist):
         try:
             result = brokerActivityPool.get(timeout=1)
@@ -229,8 +266,11 @@ try:
         if result:
             (code, broker_activity_data) = result
             if broker_activity_data is None:
-                brokerActivityPool.put(BrokerActivityTask(code))
-                print("Retrying broker activity for %d ..." % code, file=sys.stderr)
+                if brokerActivityPool.retry(code):
+                    print("Retrying broker activity for %d ..." % code, file=sys.stderr)
+                else:
+                    count += 1
+                    print("Giving up broker activity for %d." % code, file=sys.stderr)
             else:
                 broker_activities[code] = broker_activity_data
                 count += 1
@@ -240,8 +280,10 @@ except KeyboardInterrupt:
 finally:
     brokerActivityPool.terminate()
 
+write_dead_letters("broker_activity", brokerActivityPool.dead_letters)
+
 toDelete = []
-for code in data_whitelist:
+for code in broker_activities:
     if not broker_activities[code]:
         toDelete += [code]
 for c in toDelete:
@@ -346,11 +388,11 @@ class IndustryTask:
 industries = {}
 
 try:
-    industriesPool = worker.WorkerPool(options.workers)
+    industriesPool = create_pool()
     industriesPool.start()
     count = 0
     for code in data_whitelist:
-        industriesPool.put(IndustryTask(code))
+        industriesPool.put(IndustryTask(code), code, host="quotes.wsj.com")
     while count < len(data_whitelist):
         try:
             result = industriesPool.get(timeout=1)
@@ -359,7 +401,9 @@ try:
         if result:
             (code, industry_data) = result
             if not industry_data:
-                industriesPool.put(IndustryTask(code))
+                if not industriesPool.retry(code):
+                    count += 1
+                    print("Giving up industry for %d." % code, file=sys.stderr)
             else:
                 industries[code] = industry_data
                 count += 1
@@ -368,10 +412,12 @@ except KeyboardInterrupt:
 finally:
     industriesPool.terminate()
 
+write_dead_letters("industries", industriesPool.dead_letters)
+
 if not os.path.exists(os.path.join(options.directory, industry_file)):
     records.create_records(os.path.join(options.directory, industry_file), ["code", "timestamp"] + list(batch.Industry._fields))
 
-records.insert_records(os.path.join(options.directory, industry_file), [tuple([code, datetime.strptime(options.date + "2359+0800", "%Y%m%d%H%M%z").timestamp()]) + industries[code] for code in data_whitelist])
+records.insert_records(os.path.join(options.directory, industry_file), [tuple([code, datetime.strptime(options.date + "2359+0800", "%Y%m%d%H%M%z").timestamp()]) + industries[code] for code in data_whitelist if code in industries])
 
 del industriesPool
 del industries
@@ -395,11 +441,11 @@ class EmployeesTask:
 employees = {}
 
 try:
-    employeesPool = worker.WorkerPool(options.workers)
+    employeesPool = create_pool()
     employeesPool.start()
     count = 0
     for code in data_whitelist:
-        employeesPool.put(EmployeesTask(code))
+        employeesPool.put(EmployeesTask(code), code, host="quotes.wsj.com")
     while count < len(data_whitelist):
         try:
             result = employeesPool.get(timeout=1)
@@ -408,7 +454,9 @@ try:
         if result:
             (code, employees_data) = result
             if not employees_data:
-                employeesPool.put(EmployeesTask(code))
+                if not employeesPool.retry(code):
+                    count += 1
+                    print("Giving up employees for %d." % code, file=sys.stderr)
             else:
                 employees[code] = employees_data
                 count += 1
@@ -417,10 +465,12 @@ except KeyboardInterrupt:
 finally:
     employeesPool.terminate()
 
+write_dead_letters("employees", employeesPool.dead_letters)
+
 if not os.path.exists(os.path.join(options.directory, employees_file)):
     records.create_records(os.path.join(options.directory, employees_file), ["code", "timestamp", "employee_count"])
 
-records.insert_records(os.path.join(options.directory, employees_file), [tuple([code, datetime.strptime(options.date + "2359+0800", "%Y%m%d%H%M%z").timestamp(), employees[code]]) for code in data_whitelist])
+records.insert_records(os.path.join(options.directory, employees_file), [tuple([code, datetime.strptime(options.date + "2359+0800", "%Y%m%d%H%M%z").timestamp(), employees[code]]) for code in data_whitelist if code in employees])
 
 del employeesPool
 del employees
@@ -444,11 +494,11 @@ class CorporateActionsTask:
 corporate_actions = {}
 
 try:
-    corporateActionsPool = worker.WorkerPool(options.workers)
+    corporateActionsPool = create_pool()
     corporateActionsPool.start()
     count = 0
     for code in data_whitelist:
-        corporateActionsPool.put(CorporateActionsTask(code))
+        corporateActionsPool.put(CorporateActionsTask(code), code, host="www.aastocks.com")
     while count < len(data_whitelist):
         try:
             result = corporateActionsPool.get(timeout=1)
@@ -457,8 +507,11 @@ try:
         if result:
             (code, corporate_actions_data) = result
             if corporate_actions_data is None:
-                corporateActionsPool.put(CorporateActionsTask(code))
-                print("Retrying corporate actions for %d ..." % code, file=sys.stderr)
+                if corporateActionsPool.retry(code):
+                    print("Retrying corporate actions for %d ..." % code, file=sys.stderr)
+                else:
+                    count += 1
+                    print("Giving up corporate actions for %d." % code, file=sys.stderr)
             else:
                 corporate_actions[code] = corporate_actions_data
                 count += 1
@@ -468,11 +521,13 @@ except KeyboardInterrupt:
 finally:
     corporateActionsPool.terminate()
 
+write_dead_letters("corporate_actions", corporateActionsPool.dead_letters)
+
 if not os.path.exists(os.path.join(options.directory, corporate_actions_file)):
     records.create_records(os.path.join(options.directory, corporate_actions_file), ["code"] + list(batch.CorporateAction._fields))
 
 corporateActionsRecords = []
-for code in data_whitelist:
+for code in [ code for code in data_whitelist if code in corporate_actions ]:
     corporateActionsRecords += [ tuple([code]) + c for c in corporate_actions[code] ]
 records.insert_records(os.path.join(options.directory, corporate_actions_file), corporateActionsRecords)
 
@@ -499,11 +554,11 @@ class SharesTask:
 shares = {}
 
 try:
-    sharesPool = worker.WorkerPool(options.workers)
+    sharesPool = create_pool()
     sharesPool.start()
     count = 0
     for code in data_whitelist:
-        sharesPool.put(SharesTask(code))
+        sharesPool.put(SharesTask(code), code, host="www.aastocks.com")
     while count < len(data_whitelist):
         try:
             result = sharesPool.get(timeout=1)
@@ -512,7 +567,9 @@ try:
         if result:
             (code, shares_data) = result
             if not shares_data:
-                sharesPool.put(SharesTask(code))
+                if not sharesPool.retry(code):
+                    count += 1
+                    print("Giving up issued shares for %d." % code, file=sys.stderr)
             else:
                 shares[code] = shares_data
                 count += 1
@@ -521,10 +578,12 @@ except KeyboardInterrupt:
 finally:
     sharesPool.terminate()
 
+write_dead_letters("shares", sharesPool.dead_letters)
+
 if not os.path.exists(os.path.join(options.directory, shares_file)):
     records.create_records(os.path.join(options.directory, shares_file), ["code", "timestamp"] + list(batch.IssuedShares._fields))
 
-records.insert_records(os.path.join(options.directory, shares_file), [tuple([code, datetime.strptime(options.date + "2359+0800", "%Y%m%d%H%M%z").timestamp()]) + shares[code] for code in data_whitelist])
+records.insert_records(os.path.join(options.directory, shares_file), [tuple([code, datetime.strptime(options.date + "2359+0800", "%Y%m%d%H%M%z").timestamp()]) + shares[code] for code in data_whitelist if code in shares])
 
 del sharesPool
 del shares
@@ -548,11 +607,11 @@ class InstitutionsTask:
 institutions = {}
 
 try:
-    institutionsPool = worker.WorkerPool(options.workers)
+    institutionsPool = create_pool()
     institutionsPool.start()
     count = 0
     for code in data_whitelist:
-        institutionsPool.put(InstitutionsTask(code))
+        institutionsPool.put(InstitutionsTask(code), code, host="www.reuters.com")
     while count < len(data_whitelist):
         try:
             result = institutionsPool.get(timeout=1)
@@ -561,7 +620,9 @@ try:
         if result:
             (code, institutions_data) = result
             if not institutions_data:
-                institutionsPool.put(InstitutionsTask(code))
+                if not institutionsPool.retry(code):
+                    count += 1
+                    print("Giving up institutional shares for %d." % code, file=sys.stderr)
             else:
                 institutions[code] = institutions_data
                 count += 1
@@ -570,10 +631,12 @@ except KeyboardInterrupt:
 finally:
     institutionsPool.terminate()
 
+write_dead_letters("institutions", institutionsPool.dead_letters)
+
 if not os.path.exists(os.path.join(options.directory, institutions_file)):
     records.create_records(os.path.join(options.directory, institutions_file), ["code", "timestamp"] + list(batch.InstitutionalShares._fields))
 
-records.insert_records(os.path.join(options.directory, institutions_file), [tuple([code, datetime.strptime(options.date + "2359+0800", "%Y%m%d%H%M%z").timestamp()]) + institutions[code] for code in data_whitelist])
+records.insert_records(os.path.join(options.directory, institutions_file), [tuple([code, datetime.strptime(options.date + "2359+0800", "%Y%m%d%H%M%z").timestamp()]) + institutions[code] for code in data_whitelist if code in institutions])
 
 del institutionsPool
 del institutions
@@ -597,11 +660,11 @@ class FundamentalsTask:
 fundamentals = {}
 
 try:
-    fundamentalsPool = worker.WorkerPool(options.workers)
+    fundamentalsPool = create_pool()
     fundamentalsPool.start()
     count = 0
     for code in data_whitelist:
-        fundamentalsPool.put(FundamentalsTask(code))
+        fundamentalsPool.put(FundamentalsTask(code), code, host="markets.ft.com")
     while count < len(data_whitelist):
         try:
             result = fundamentalsPool.get(timeout=1)
@@ -610,8 +673,11 @@ try:
         if result:
             (code, fundamentals_data) = result
             if fundamentals_data is None:  #
-                fundamentalsPool.put(FundamentalsTask(code))
-                print("Retrying fundamentals for %d ..." % code, file=sys.stderr)
+                if fundamentalsPool.retry(code):
+                    print("Retrying fundamentals for %d ..." % code, file=sys.stderr)
+                else:
+                    count += 1
+                    print("Giving up fundamentals for %d." % code, file=sys.stderr)
             else:
                 for key in fundamentals_data:
                     fundamentals[key] = fundamentals_data[key]
@@ -622,6 +688,8 @@ except KeyboardInterrupt:
 finally:
     fundamentalsPool.terminate()
 
+write_dead_letters("fundamentals", fundamentalsPool.dead_letters)
+
 if not os.path.exists(os.path.join(options.directory, fundamentals_file)):
     records.create_records(os.path.join(options.directory, fundamentals_file), ["key", "timestamp"] + list(batch.Fundamentals._fields))
 
@@ -649,11 +717,11 @@ class FundamentalsLtmTask:
 fundamentals_ltm = {}
 
 try:
-    fundamentalsLtmPool = worker.WorkerPool(options.workers)
+    fundamentalsLtmPool = create_pool()
     fundamentalsLtmPool.start()
     count = 0
     for code in data_whitelist:
-        fundamentalsLtmPool.put(FundamentalsLtmTask(code))
+        fundamentalsLtmPool.put(FundamentalsLtmTask(code), code, host="markets.ft.com")
     while count < len(data_whitelist):
         try:
             result = fundamentalsLtmPool.get(timeout=1)
@@ -662,8 +730,11 @@ try:
         if result:
             (code, fundamentals_ltm_data) = result
             if fundamentals_ltm_data is None:  #
-                fundamentalsLtmPool.put(FundamentalsLtmTask(code))
-                print("Retrying fundamentals - LTM for %d ..." % code, file=sys.stderr)
+                if fundamentalsLtmPool.retry(code):
+                    print("Retrying fundamentals - LTM for %d ..." % code, file=sys.stderr)
+                else:
+                    count += 1
+                    print("Giving up fundamentals - LTM for %d." % code, file=sys.stderr)
             else:
                 for key in fundamentals_ltm_data:
                     fundamentals_ltm[key] = fundamentals_ltm_data[key]
@@ -674,6 +745,8 @@ except KeyboardInterrupt:
 finally:
     fundamentalsLtmPool.terminate()
 
+write_dead_letters("fundamentals_ltm", fundamentalsLtmPool.dead_letters)
+
 if not os.path.exists(os.path.join(options.directory, fundamentals_ltm_file)):
     records.create_records(os.path.join(options.directory, fundamentals_ltm_file), ["key", "timestamp"] + list(batch.Fundamentals._fields))
 
@@ -701,11 +774,11 @@ class ForecastsTask:
 forecasts = {}
 
 try:
-    forecastsPool = worker.WorkerPool(options.workers)
+    forecastsPool = create_pool()
     forecastsPool.start()
     count = 0
     for code in data_whitelist:
-        forecastsPool.put(ForecastsTask(code))
+        forecastsPool.put(ForecastsTask(code), code, host="markets.ft.com")
     while count < len(data_whitelist):
         try:
             result = forecastsPool.get(timeout=1)
@@ -714,8 +787,11 @@ try:
         if result:
             (code, forecasts_data) = result
             if forecasts_data is None:  #
-                forecastsPool.put(ForecastsTask(code))
-                print("Retrying forecasts for %d ..." % code, file=sys.stderr)
+                if forecastsPool.retry(code):
+                    print("Retrying forecasts for %d ..." % code, file=sys.stderr)
+                else:
+                    count += 1
+                    print("Giving up forecasts for %d." % code, file=sys.stderr)
             else:
                 for key in forecasts_data:
                     forecasts[key] = forecasts_data[key]
@@ -726,6 +802,8 @@ except KeyboardInterrupt:
 finally:
     forecastsPool.terminate()
 
+write_dead_letters("forecasts", forecastsPool.dead_letters)
+
 if not os.path.exists(os.path.join(options.directory, forecasts_file)):
     records.create_records(os.path.join(options.directory, forecasts_file), ["key", "timestamp"] + list(batch.ForecastedFundamentals._fields))
 
@@ -753,11 +831,11 @@ class RatingsTask:
 ratings = {}
 
 try:
-    ratingsPool = worker.WorkerPool(options.workers)
+    ratingsPool = create_pool()
     ratingsPool.start()
     count = 0
     for code in data_whitelist:
-        ratingsPool.put(RatingsTask(code))
+        ratingsPool.put(RatingsTask(code), code, host="markets.ft.com")
     while count < len(data_whitelist):
         try:
             result = ratingsPool.get(timeout=1)
@@ -766,8 +844,11 @@ try:
         if result:
             (code, ratings_data) = result
             if not ratings_data:
-                ratingsPool.put(RatingsTask(code))
-                print("Retrying ratings for %d ..." % code, file=sys.stderr)
+                if ratingsPool.retry(code):
+                    print("Retrying ratings for %d ..." % code, file=sys.stderr)
+                else:
+                    count += 1
+                    print("Giving up ratings for %d." % code, file=sys.stderr)
             else:
                 ratings[code] = ratings_data
                 count += 1
@@ -777,10 +858,12 @@ except KeyboardInterrupt:
 finally:
     ratingsPool.terminate()
 
+write_dead_letters("ratings", ratingsPool.dead_letters)
+
 if not os.path.exists(os.path.join(options.directory, ratings_file)):
     records.create_records(os.path.join(options.directory, ratings_file), ["code", "timestamp"] + list(batch.Ratings._fields))
 
-records.insert_records(os.path.join(options.directory, ratings_file), [tuple([code, datetime.strptime(options.date + "2359+0800", "%Y%m%d%H%M%z").timestamp()]) + ratings[code] for code in data_whitelist])
+records.insert_records(os.path.join(options.directory, ratings_file), [tuple([code, datetime.strptime(options.date + "2359+0800", "%Y%m%d%H%M%z").timestamp()]) + ratings[code] for code in data_whitelist if code in ratings])
 
 del ratingsPool
 del ratings
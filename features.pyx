@@ -4,6 +4,9 @@
 
 cimport cython
 cimport numpy
+from cython.parallel cimport prange
+cimport openmp
+from libc.math cimport log, exp, NAN
 
 import sys
 import datetime as dtime
@@ -11,10 +14,7 @@ from datetime import datetime
 from collections import namedtuple
 import re
 import cython
-import statsmodels.robust
 import numpy
-import pandas
-import pywt
 
 import bars
 import xs
@@ -33,15 +33,23 @@ market_open_days = 252
 
 # Data Structures
 
+TargetSpec = namedtuple("TargetSpec", ["target", "function_name", "args", "width"])
+
 # Utility Functions
 
-def split_series(series, split_timestamp):
+def split_series(series, split_timestamp, expected_range=None):
     independent_series = series[series['timestamp'] <= split_timestamp]['px_open']
-    realized_series = series[series['timestamp'] < split_timestamp]
-    expected_range = numpy.sqrt(xs.get_volatility_ohlc(numpy.log(realized_series['px_open'].values), numpy.log(realized_series['px_high'].values), numpy.log(realized_series['px_low'].values), numpy.log(realized_series['px_last'].values)) * market_open_minutes * 4 * numpy.log(2))
+    if expected_range is None:
+        expected_range = get_expected_ranges(series, [split_timestamp])[0]
     dependent_series = series[series['timestamp'] >= split_timestamp].reset_index(drop=True)  #
     return (independent_series, expected_range, dependent_series)
 
+def get_expected_ranges(series, split_timestamps):
+    # Expected ranges for several split times at once: each split's realized series is a prefix of the same series
+    lengths = numpy.searchsorted(series['timestamp'].values, split_timestamps, side='left')
+    ohlc = [ numpy.tile(numpy.log(series[field].values), (len(lengths), 1)) for field in ['px_open', 'px_high', 'px_low', 'px_last'] ]
+    return numpy.sqrt(xs.get_volatility_ohlc_batch(ohlc[0], ohlc[1], ohlc[2], ohlc[3], lengths=lengths) * market_open_minutes * 4 * numpy.log(2))
+
 # Wavelet features
 
 def generate_wavelet_features(series, wavelet, detail, scaling):
@@ -51,12 +59,38 @@ def generate_wavelet_features(series, wavelet, detail, scaling):
         res = numpy.append(res, coefs[level][-detail:] * (scaling ** (level - 1)))
     return res
 
+def wavelet_feature_count(n, detail):
+    # Detail coefficients kept per level of a periodized decomposition of a length-n series
+    l = int(numpy.ceil(numpy.log2(n)))
+    return sum([ min(detail, int(numpy.ceil(n / 2**level))) for level in range(1, l + 1) ])
+
+def generate_wavelet_features_batch(series, wavelets, detail, scaling, out=None):
+    # Same-length series one per row; the features of wavelets[i] fill columns [i * k, (i + 1) * k) of the output
+    (m, n) = series.shape
+    k = wavelet_feature_count(n, detail)
+    out = numpy.empty((m, len(wavelets) * k)) if out is None else out
+    for (i, wavelet) in enumerate(wavelets):
+        coefs = transform.wavelet_transform_batch(series, wavelet)
+        column = i * k
+        for level in range(1, len(coefs)):
+            width = min(detail, coefs[level].shape[1])
+            out[:, column:column + width] = coefs[level][:, -detail:] * (scaling ** (level - 1))
+            column += width
+    return out
+
 # Dependent variables and helper functions
 
 target_re = re.compile("([A-Za-z0-9_]+)\(([0-9.]+)\)")
 
-def generate_targets(series, expected_range, target_list):
-    requests = []
+target_widths = { "excursion": 2, "trailing_stop_trade": 2, "pullback_trade": 2 }
+target_plans = {}
+
+def compile_targets(target_list):
+    # Parse target strings like pullback_trade(0.8)(1.2) once into a plan of TargetSpecs
+    key = tuple(target_list)
+    if key in target_plans:
+        return target_plans[key]
+    plan = []
     for target in target_list:
         function_name = None
         args = []
@@ -69,20 +103,83 @@ def generate_targets(series, expected_range, target_list):
                 function_name = m.group(1)
             args += [float(m.group(2))]
             tmp_target = tmp_target.replace("(%s)" % m.group(2), "", 1)
-        requests += [(target, function_name, args)]
+        plan += [TargetSpec(target=target, function_name=function_name, args=tuple(args), width=target_widths[function_name])]
+    target_plans[key] = plan
+    return plan
+
+def target_names(plan):
+    return [ "%s_%d" % (spec.target, i + 1) for spec in plan for i in range(0, spec.width) ]
+
+def target_columns(plan):
+    columns = {}
+    column = 0
+    for spec in plan:
+        columns[spec.target] = slice(column, column + spec.width)
+        column += spec.width
+    return columns
+
+def generate_targets(series, expected_range, target_list):
     res = numpy.array([])
-    res_names = []
-    for (target, function_name, args) in requests:
-        if function_name == "excursion":
+    for spec in compile_targets(target_list):
+        if spec.function_name == "excursion":
             func = generate_excursion
-        if function_name == "trailing_stop_trade":
+        if spec.function_name == "trailing_stop_trade":
             func = generate_trailing_stop_trade
-        elif function_name == "pullback_trade":
+        elif spec.function_name == "pullback_trade":
             func = generate_pullback_trade
-        ret = func(series, expected_range, *args)
+        ret = func(series, expected_range, *spec.args)
         res = numpy.append(res, ret)
-        res_names += ["%s_%d" % (target, i + 1) for i in range(0, len(ret))]
-    return (res, res_names)
+    return (res, target_names(compile_targets(target_list)))
+
+def sweep_targets(stop_loss_ratios, pullback_ratios=[]):
+    # Target strings for a grid of trailing stops and of (pullback, stop-loss) pairs, for compile_targets
+    return [ "trailing_stop_trade(%g)" % s for s in stop_loss_ratios ] + [ "pullback_trade(%g)(%g)" % (b, s) for b in pullback_ratios for s in stop_loss_ratios ]
+
+def stack_ohlc(series_list):
+    # NaN-padded (series x bars) open/high/low/last blocks and the series lengths
+    lengths = numpy.array([ s.shape[0] for s in series_list ], dtype=numpy.intp)
+    blocks = [ numpy.full((len(series_list), max(lengths.max(), 1) if len(series_list) > 0 else 1), numpy.nan) for i in range(0, 4) ]
+    for (r, s) in enumerate(series_list):
+        for (block, field) in zip(blocks, ['px_open', 'px_high', 'px_low', 'px_last']):
+            block[r, :lengths[r]] = s[field].values
+    return (blocks[0], blocks[1], blocks[2], blocks[3], lengths)
+
+def generate_targets_batch(o, h, l, c, lengths, expected_ranges, plan):
+    # All samples at once: one row per sample of the (samples x bars) OHLC block, valid up to lengths, with the
+    # trade simulators run for every parameter set of the plan in one parallel kernel call each
+    o = numpy.ascontiguousarray(o, dtype=numpy.float64)
+    h = numpy.ascontiguousarray(h, dtype=numpy.float64)
+    l = numpy.ascontiguousarray(l, dtype=numpy.float64)
+    c = numpy.ascontiguousarray(c, dtype=numpy.float64)
+    lengths = numpy.ascontiguousarray(lengths, dtype=numpy.intp)
+    expected_ranges = numpy.ascontiguousarray(expected_ranges, dtype=numpy.float64)
+    m = o.shape[0]
+    res = numpy.empty((m, sum([ spec.width for spec in plan ])))
+    columns = {}
+    column = 0
+    for spec in plan:
+        columns.setdefault(spec.function_name, []).append((column, spec))
+        column += spec.width
+    for (column, spec) in columns.get("excursion", []):
+        valid = numpy.arange(o.shape[1]) < lengths.reshape((m, 1))
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            res[:, column] = numpy.log(numpy.max(numpy.where(valid, h, -numpy.inf), axis=1) / o[:, 0])
+            res[:, column + 1] = numpy.log(o[:, 0] / numpy.min(numpy.where(valid, l, numpy.inf), axis=1))
+    if "trailing_stop_trade" in columns:
+        specs = columns["trailing_stop_trade"]
+        ret = generate_trailing_stop_trade_batch(o, h, l, c, lengths, expected_ranges, numpy.array([ spec.args[0] for (column, spec) in specs ], dtype=numpy.float64))
+        for (k, (column, spec)) in enumerate(specs):
+            res[:, column:column + 2] = ret[:, k, :]
+    if "pullback_trade" in columns:
+        specs = columns["pullback_trade"]
+        ret = generate_pullback_trade_batch(o, h, l, c, lengths, expected_ranges, numpy.array([ spec.args[0] for (column, spec) in specs ], dtype=numpy.float64), numpy.array([ spec.args[1] for (column, spec) in specs ], dtype=numpy.float64))
+        for (k, (column, spec)) in enumerate(specs):
+            res[:, column:column + 2] = ret[:, k, :]
+    return (res, target_names(plan))
+
+def set_num_threads(n):
+    # Threads per parallel kernel call, e.g. 1 in worker processes that already run one per core
+    openmp.omp_set_num_threads(n)
 
 # args:
 # []
@@ -199,3 +296,140 @@ cpdef numpy.ndarray[double] generate_pullback_trade_c(numpy.ndarray o, numpy.nda
         short_stop = c[n-1]
     return numpy.log([long_stop / long_open, short_open / short_stop])
 
+# Batch kernels over (samples x bars) blocks and a vector of parameter sets, parallel over samples
+
+# One pass over each row's bars updates every parameter set, sharing the running high/low
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void trailing_stop_trade_sweep_row(const double[:, ::1] o, const double[:, ::1] h, const double[:, ::1] l, const double[:, ::1] c, Py_ssize_t r, Py_ssize_t n, const double[:, ::1] stop_loss_returns, unsigned char[:, :, ::1] stopped, double[:, :, ::1] out) noexcept nogil:
+    cdef Py_ssize_t p = stop_loss_returns.shape[1]
+    cdef Py_ssize_t i, k
+    cdef Py_ssize_t active = p
+    for k in range(p):
+        out[r, k, 0] = o[r, 0] / stop_loss_returns[r, k]
+        out[r, k, 1] = o[r, 0] * stop_loss_returns[r, k]
+        stopped[r, k, 0] = 0
+        stopped[r, k, 1] = 0
+    for i in range(0, n):
+        if active == 0:
+            break
+        for k in range(p):
+            if stopped[r, k, 0] and stopped[r, k, 1]:
+                continue
+            if not stopped[r, k, 0]:
+                if l[r, i] < out[r, k, 0]:
+                    out[r, k, 0] = l[r, i]
+                    stopped[r, k, 0] = 1
+                elif l[r, i] / stop_loss_returns[r, k] > out[r, k, 0]:
+                    out[r, k, 0] = l[r, i] / stop_loss_returns[r, k]
+            if not stopped[r, k, 1]:
+                if h[r, i] > out[r, k, 1]:
+                    out[r, k, 1] = h[r, i]
+                    stopped[r, k, 1] = 1
+                elif h[r, i] * stop_loss_returns[r, k] < out[r, k, 1]:
+                    out[r, k, 1] = h[r, i] * stop_loss_returns[r, k]
+            if stopped[r, k, 0] and stopped[r, k, 1]:
+                active -= 1
+    for k in range(p):
+        if not stopped[r, k, 0]:
+            out[r, k, 0] = c[r, n-1]
+        if not stopped[r, k, 1]:
+            out[r, k, 1] = c[r, n-1]
+        out[r, k, 0] = log(out[r, k, 0] / o[r, 0])
+        out[r, k, 1] = log(o[r, 0] / out[r, k, 1])
+
+# Pullback state per parameter set: [long open, long stop, short open, short stop] and [long opened, long stopped,
+# short opened, short stopped]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void pullback_trade_sweep_row(const double[:, ::1] o, const double[:, ::1] h, const double[:, ::1] l, const double[:, ::1] c, Py_ssize_t r, Py_ssize_t n, const double[:, ::1] pullback_returns, const double[:, ::1] stop_loss_returns, double[:, :, ::1] state, unsigned char[:, :, ::1] flags, double[:, :, ::1] out) noexcept nogil:
+    cdef Py_ssize_t p = stop_loss_returns.shape[1]
+    cdef Py_ssize_t i, k
+    cdef Py_ssize_t active = p
+    cdef double current_high = o[r, 0]
+    cdef double current_low = o[r, 0]
+    for k in range(p):
+        for i in range(4):
+            state[r, k, i] = NAN
+            flags[r, k, i] = 0
+    for i in range(0, n):
+        if active == 0:
+            break
+        for k in range(p):
+            if flags[r, k, 1] and flags[r, k, 3]:
+                continue
+            if flags[r, k, 0]:
+                if not flags[r, k, 1]:
+                    if l[r, i] < state[r, k, 1]:
+                        state[r, k, 1] = l[r, i]
+                        flags[r, k, 1] = 1
+                    elif l[r, i] / stop_loss_returns[r, k] > state[r, k, 1]:
+                        state[r, k, 1] = l[r, i] / stop_loss_returns[r, k]
+            elif o[r, i] < current_high / pullback_returns[r, k]:
+                flags[r, k, 0] = 1
+                state[r, k, 0] = current_high / pullback_returns[r, k]
+                state[r, k, 1] = state[r, k, 0] / stop_loss_returns[r, k]
+            if flags[r, k, 2]:
+                if not flags[r, k, 3]:
+                    if h[r, i] > state[r, k, 3]:
+                        state[r, k, 3] = h[r, i]
+                        flags[r, k, 3] = 1
+                    elif h[r, i] * stop_loss_returns[r, k] < state[r, k, 3]:
+                        state[r, k, 3] = h[r, i] * stop_loss_returns[r, k]
+            elif o[r, i] > current_low * pullback_returns[r, k]:
+                flags[r, k, 2] = 1
+                state[r, k, 2] = current_low * pullback_returns[r, k]
+                state[r, k, 3] = state[r, k, 2] * stop_loss_returns[r, k]
+            if flags[r, k, 1] and flags[r, k, 3]:
+                active -= 1
+        current_high = max(current_high, h[r, i])
+        current_low = min(current_low, l[r, i])
+    for k in range(p):
+        if flags[r, k, 0]:
+            if not flags[r, k, 1]:
+                state[r, k, 1] = c[r, n-1]
+        else:
+            state[r, k, 0] = c[r, n-1]
+            state[r, k, 1] = c[r, n-1]
+        if flags[r, k, 2]:
+            if not flags[r, k, 3]:
+                state[r, k, 3] = c[r, n-1]
+        else:
+            state[r, k, 2] = c[r, n-1]
+            state[r, k, 3] = c[r, n-1]
+        out[r, k, 0] = log(state[r, k, 1] / state[r, k, 0])
+        out[r, k, 1] = log(state[r, k, 2] / state[r, k, 3])
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def generate_trailing_stop_trade_batch(const double[:, ::1] o, const double[:, ::1] h, const double[:, ::1] l, const double[:, ::1] c, const Py_ssize_t[::1] lengths, const double[::1] expected_ranges, const double[::1] stop_loss_ratios):
+    cdef Py_ssize_t m = o.shape[0]
+    cdef Py_ssize_t p = stop_loss_ratios.shape[0]
+    cdef Py_ssize_t r
+    res = numpy.full((m, p, 2), numpy.nan)
+    cdef double[:, :, ::1] out = res
+    cdef double[:, ::1] stop_loss_returns = numpy.exp(numpy.outer(expected_ranges, stop_loss_ratios))
+    cdef unsigned char[:, :, ::1] stopped = numpy.zeros((m, p, 2), dtype=numpy.uint8)
+    for r in prange(m, nogil=True, schedule='dynamic'):
+        if lengths[r] > 0:
+            trailing_stop_trade_sweep_row(o, h, l, c, r, lengths[r], stop_loss_returns, stopped, out)
+    return res
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def generate_pullback_trade_batch(const double[:, ::1] o, const double[:, ::1] h, const double[:, ::1] l, const double[:, ::1] c, const Py_ssize_t[::1] lengths, const double[::1] expected_ranges, const double[::1] pullback_ratios, const double[::1] stop_loss_ratios):
+    cdef Py_ssize_t m = o.shape[0]
+    cdef Py_ssize_t p = pullback_ratios.shape[0]
+    cdef Py_ssize_t r
+    res = numpy.full((m, p, 2), numpy.nan)
+    cdef double[:, :, ::1] out = res
+    cdef double[:, ::1] pullback_returns = numpy.exp(numpy.outer(expected_ranges, pullback_ratios))
+    cdef double[:, ::1] stop_loss_returns = numpy.exp(numpy.outer(expected_ranges, stop_loss_ratios))
+    cdef double[:, :, ::1] state = numpy.empty((m, p, 4))
+    cdef unsigned char[:, :, ::1] flags = numpy.zeros((m, p, 4), dtype=numpy.uint8)
+    for r in prange(m, nogil=True, schedule='dynamic'):
+        if lengths[r] > 0:
+            pullback_trade_sweep_row(o, h, l, c, r, lengths[r], pullback_returns, stop_loss_returns, state, flags, out)
+    return res
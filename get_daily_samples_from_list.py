@@ -52,6 +52,7 @@ for line in lines:
             pass
 
 prices_folder = configParser.get("Main", "prices_folder")
+columnar_prices_folder = configParser.get("Main", "columnar_prices_folder")
 
 dates = sorted(os.listdir(os.path.join(options.directory, prices_folder)))
 dates = [d for d in dates if d <= options.date]
@@ -65,13 +66,16 @@ dates = dates[-min_turnover_days:]
 foos = {}
 
 for d in dates:
-    foo = bars.read_all_bars(os.path.join(options.directory, prices_folder, d))
+    foo = bars.read_all_bars_store(os.path.join(options.directory, prices_folder, d), os.path.join(options.directory, columnar_prices_folder, d))
     for code in foo:
         if code not in eligible_codes:
             continue
         if code not in foos:
             foos[code] = []
-        foos[code] += foo[code]
+        foos[code] += [foo[code]]
+
+for code in foos:
+    foos[code] = bars.concatenate_bars(foos[code])
 
 # Finalized list here
 
@@ -84,45 +88,10 @@ print(eligible_pairs, file=sys.stderr)
 # Clean Auction and Market Open Ticks
 # Fill back morning/afternoon Ticks
 
-auction_time = datetime.strptime(bars.market_auction, "%H:%M:%S%z")
-market_am_open_time = datetime.strptime(bars.market_am_open, "%H:%M:%S%z")
-market_pm_open_time = datetime.strptime(bars.market_pm_open, "%H:%M:%S%z")
-market_am_close_time = datetime.strptime(bars.market_am_close, "%H:%M:%S%z")
-market_pm_close_time = datetime.strptime(bars.market_pm_close, "%H:%M:%S%z")
+calendar = bars.TradingCalendar(dates)
 
 for code in eligible_codes:
-    toDelete = []
-    for i in range(0, len(foos[code])):
-        ts = datetime.fromtimestamp(foos[code][i].timestamp)
-        if (ts.hour == auction_time.hour and ts.minute == auction_time.minute) or (ts.hour == market_am_open_time.hour and ts.minute == market_am_open_time.minute) or (ts.hour == market_pm_open_time.hour and ts.minute == market_pm_open_time.minute):
-            toDelete += [i]
-    for i in sorted(toDelete, reverse=True):
-        del foos[code][i]
-    patched = []
-    for i in range(0, len(foos[code])):
-        ts = datetime.fromtimestamp(foos[code][i].timestamp)
-        last_ts = datetime.fromtimestamp(foos[code][i-1].timestamp) if i > 0 else None
-        next_ts = datetime.fromtimestamp(foos[code][i+1].timestamp) if i < len(foos[code]) - 1 else None
-        if (ts.hour == market_pm_open_time.hour and ts.minute == market_pm_open_time.minute + 1):
-            last_px = None
-            if last_ts is None:
-                last_px = foos[code][i].px_open
-            elif (last_ts.hour == market_pm_close_time.hour and last_ts.minute == market_pm_close_time.minute):
-                last_px = foos[code][i-1].px_last
-            if last_px is not None:
-                tmp_ts = datetime.combine(ts.date(), market_am_open_time.time()).timestamp()
-                while tmp_ts % 86400 < market_am_close_time.timestamp() % 86400:
-                    tmp_ts += 60
-                    patched += [bars.Bar(timestamp=tmp_ts, px_open=last_px, px_high=last_px, px_low=last_px, px_last=last_px, px_volume=0)]
-        patched += [foos[code][i]]
-        if (ts.hour == market_am_close_time.hour and ts.minute == market_am_close_time.minute):
-            if next_ts is None or (next_ts.hour == market_am_open_time.hour and next_ts.minute == market_am_open_time.minute + 1):
-                last_px = foos[code][i].px_last
-                tmp_ts = ts.timestamp() + (market_pm_open_time - market_am_close_time).seconds
-                while tmp_ts % 86400 < market_pm_close_time.timestamp() % 86400:
-                    tmp_ts += 60
-                    patched += [bars.Bar(timestamp=tmp_ts, px_open=last_px, px_high=last_px, px_low=last_px, px_last=last_px, px_volume=0)]
-    foos[code] = patched
+    foos[code] = bars.patch_bars(foos[code], calendar)
 
 # Write Output
 
@@ -10,6 +10,7 @@ import queue
 from optparse import OptionParser
 import configparser
 import zmq
+import numpy
 
 import bars
 
@@ -57,6 +58,7 @@ market_open_duration_in_minutes = bars.market_open_duration // 60
 # Preprocess
 
 prices_folder = configParser.get("Main", "prices_folder")
+columnar_prices_folder = configParser.get("Main", "columnar_prices_folder")
 
 dates = sorted(os.listdir(os.path.join(options.directory, prices_folder)))
 dates = [d for d in dates if d <= options.date]
@@ -64,12 +66,14 @@ dates = [d for d in dates if d <= options.date]
 if len(dates) > options.days:
     dates = dates[-options.days:]
 
+calendar = bars.TradingCalendar(dates)
+
 counts = {}
 foos = {}
 average_volumes = {}
 
 for d in dates:
-    foo = bars.read_all_bars(os.path.join(options.directory, prices_folder, d))
+    foo = bars.read_all_bars_store(os.path.join(options.directory, prices_folder, d), os.path.join(options.directory, columnar_prices_folder, d))
     for code in foo:
         if code not in data_whitelist:
             continue
@@ -78,16 +82,18 @@ for d in dates:
         if code not in foos:
             foos[code] = []
         counts[code] += 1
-        foos[code] += foo[code]
+        foos[code] += [foo[code]]
+
+for code in foos:
+    foos[code] = bars.concatenate_bars(foos[code])
 
 for code in foos:
+    minutes = calendar.time_since_open(foos[code].timestamp) // 60
+    order = numpy.argsort(minutes, kind='stable')
+    volumes_to_date = numpy.concatenate(([0], numpy.cumsum(foos[code].px_volume[order])))
     average_volumes[code] = {}
-    for i in range(1, market_open_duration_in_minutes + 1):
-        v = 0
-        for bar in foos[code]:
-            if bars.time_since_open(datetime.fromtimestamp(bar.timestamp)) // 60 <= i:
-                v += bar.px_volume
-        average_volumes[code][i] = v / counts[code]
+    for (i, n) in zip(range(1, market_open_duration_in_minutes + 1), numpy.searchsorted(minutes[order], numpy.arange(1, market_open_duration_in_minutes + 1), side='right')):
+        average_volumes[code][i] = volumes_to_date[n] / counts[code]
 
 print("Past volume data loaded.", file=sys.stderr)
 
@@ -107,7 +113,7 @@ try:
         nfeeds += 1
         if px_volume is not None and px_volume > volumes[code]:
             volumes[code] = px_volume
-            minutes_since_open = bars.time_since_open(datetime.fromtimestamp(timestamp)) // 60 + 1
+            minutes_since_open = int(calendar.time_since_open(timestamp) // 60) + 1
             minutes_since_open = max(min(minutes_since_open, market_open_duration_in_minutes), 1)
             volume_ratio = px_volume / average_volumes[code][minutes_since_open]
             print("%d %f %f %f %f %f %f %f" % (code, timestamp, px_open, px_high, px_low, px_last, px_volume, volume_ratio), file=sys.stderr)
@@ -25,36 +25,29 @@ configParser = configparser.ConfigParser()
 configParser.read(options.config)
 
 ref_date = datetime.strptime(options.date + "2359", "%Y%m%d%H%M")
+ref_timestamp = ref_date.timestamp()
 
 # Utility Functions
 
 financial_period_map = { "1stQuarterly" : 0, "Interim" : 1, "3rdQuarterly" : 2, "Final" : 3 }
 
-def get_latest_industry(f, code):
-    recs = records.get_records(f, str(code))
-    recs = [ r for r in recs if datetime.fromtimestamp(r[1]) <= ref_date ]
+def get_latest_industry(recs):
     if len(recs) < 1:
         return None
     return recs[-1][2]
 
-def get_latest_sector(f, code):
-    recs = records.get_records(f, str(code))
-    recs = [ r for r in recs if datetime.fromtimestamp(r[1]) <= ref_date ]
+def get_latest_sector(recs):
     if len(recs) < 1:
         return None
     return recs[-1][3]
 
-def get_latest_ratings(f, code):
-    recs = records.get_records(f, str(code))
-    recs = [ r for r in recs if datetime.fromtimestamp(r[1]) <= ref_date ]
+def get_latest_ratings(recs):
     if len(recs) < 1:
         return None
     ratings = batch.Ratings(buy_analysts=int(recs[-1][2]), outperform_analysts=int(recs[-1][3]), hold_analysts=int(recs[-1][4]), underperform_analysts=int(recs[-1][5]), sell_analysts=int(recs[-1][6]), target_high=float(recs[-1][7]), target_low=float(recs[-1][8]), target_median=float(recs[-1][9]), target=float(recs[-1][10]))
     return ratings
 
-def get_latest_forecasts(f, code):
-    recs = records.get_records(f, str(code))
-    recs = [ r for r in recs if datetime.fromtimestamp(r[1]) <= ref_date ]
+def get_latest_forecasts(recs):
     forecasts = {}
     if len(recs) < 1:
         return forecasts
@@ -65,9 +58,7 @@ def get_latest_forecasts(f, code):
             forecasts[key] = batch.ForecastedFundamentals(revenue_analysts=int(r[2]), revenue_high=float(r[3]), revenue_low=float(r[4]), revenue=float(r[5]), eps_analysts=int(r[6]), eps_high=float(r[7]), eps_low=float(r[8]), eps=float(r[9]), dps=float(r[10]))
     return forecasts
 
-def get_latest_fundamentals(f, code):
-    recs = records.get_records(f, str(code))
-    recs = [ r for r in recs if datetime.fromtimestamp(r[1]) <= ref_date ]
+def get_latest_fundamentals(recs):
     fundamentals = {}
     if len(recs) < 1:
         return {}  #
@@ -81,15 +72,10 @@ def get_latest_fundamentals(f, code):
     res[latest_period] = fundamentals[latest_period]
     return res
 
-def get_average_turnover(bars):
-    total_turnover = 0
-    for bar in bars:
-        total_turnover += bar.px_last * bar.px_volume
-    return total_turnover / len(bars)
+def get_average_turnover(foo):
+    return numpy.sum(foo.px_last * foo.px_volume) / len(foo)
 
-def get_latest_shares(f, code):
-    recs = records.get_records(f, str(code))
-    recs = [ r for r in recs if datetime.fromtimestamp(r[1]) <= ref_date ]
+def get_latest_shares(recs):
     if len(recs) < 1:
         return 0
     return float(recs[-1][2])
@@ -97,9 +83,9 @@ def get_latest_shares(f, code):
 def get_latest_exchange_rates(f):
     currencies = ["RMB", "USD"]
     res = { "HKD" : 1 }
+    all_recs = records.get_records_many(f, currencies)
     for currency in currencies:
-        recs = records.get_records(f, currency)
-        res[currency] = float(recs[-1][2])
+        res[currency] = float(all_recs[currency][-1][2])
     return res
 
 # Codes
@@ -125,10 +111,12 @@ industry_file = configParser.get("Main", "industry_file")
 exclude_industries = configParser.get("Scan", "exclude_industries")
 exclude_sectors = configParser.get("Scan", "exclude_sectors")
 
+industry_records = records.get_records_many(os.path.join(options.directory, industry_file), eligible_codes, as_of=ref_timestamp)
+
 toDelete = []
 for code in eligible_codes:
-    industry = get_latest_industry(os.path.join(options.directory, industry_file), code)
-    sector = get_latest_sector(os.path.join(options.directory, industry_file), code)
+    industry = get_latest_industry(industry_records[code])
+    sector = get_latest_sector(industry_records[code])
     if industry in exclude_industries or sector in exclude_sectors:
         toDelete += [code]
 
@@ -143,9 +131,11 @@ ratings_file = configParser.get("Main", "ratings_file")
 
 min_analysts_count = int(configParser.get("Scan", "min_analysts_count"))
 
+ratings_records = records.get_records_many(os.path.join(options.directory, ratings_file), eligible_codes, as_of=ref_timestamp)
+
 toDelete = []
 for code in eligible_codes:
-    ratings = get_latest_ratings(os.path.join(options.directory, ratings_file), code)
+    ratings = get_latest_ratings(ratings_records[code])
     analysts_count = (ratings.buy_analysts + ratings.outperform_analysts + ratings.hold_analysts + ratings.underperform_analysts + ratings.sell_analysts) if ratings is not None else 0
     if analysts_count < min_analysts_count:
         toDelete += [code]
@@ -160,6 +150,7 @@ print(eligible_codes, file=sys.stderr)
 # Turnover
 
 prices_folder = configParser.get("Main", "prices_folder")
+columnar_prices_folder = configParser.get("Main", "columnar_prices_folder")
 
 dates = sorted(os.listdir(os.path.join(options.directory, prices_folder)))
 dates = [d for d in dates if d <= options.date]
@@ -172,13 +163,16 @@ dates = dates[-min_turnover_days:]
 foos = {}
 
 for d in dates:
-    foo = bars.read_all_bars(os.path.join(options.directory, prices_folder, d))
+    foo = bars.read_all_bars_store(os.path.join(options.directory, prices_folder, d), os.path.join(options.directory, columnar_prices_folder, d))
     for code in foo:
         if code not in eligible_codes:
             continue
         if code not in foos:
             foos[code] = []
-        foos[code] += foo[code]
+        foos[code] += [foo[code]]
+
+for code in foos:
+    foos[code] = bars.concatenate_bars(foos[code])
 
 grouped_bars = {}
 
@@ -204,9 +198,11 @@ shares_file = configParser.get("Main", "shares_file")
 
 min_market_cap = float(configParser.get("Scan", "min_market_cap"))
 
+shares_records = records.get_records_many(os.path.join(options.directory, shares_file), eligible_codes, as_of=ref_timestamp)
+
 toDelete = []
 for code in eligible_codes:
-    shares = get_latest_shares(os.path.join(options.directory, shares_file), code)
+    shares = get_latest_shares(shares_records[code])
     market_cap = all_prices[code].px_last * shares
     if market_cap < min_market_cap:
         toDelete += [code]
@@ -228,9 +224,11 @@ all_exchange_rates = get_latest_exchange_rates(os.path.join(options.directory, e
 
 fundamentals_file = configParser.get("Main", "fundamentals_ltm_file")  #
 
+fundamentals_records = records.get_records_many(os.path.join(options.directory, fundamentals_file), eligible_codes, as_of=ref_timestamp)
+
 toDelete = []
 for code in eligible_codes:
-    fundamentals = get_latest_fundamentals(os.path.join(options.directory, fundamentals_file), code)
+    fundamentals = get_latest_fundamentals(fundamentals_records[code])
     if len(fundamentals) > 0:
         all_fundamentals_dates[code] = sorted(fundamentals)[-1]
         all_fundamentals[code] = fundamentals[all_fundamentals_dates[code]]
@@ -246,9 +244,11 @@ print(eligible_codes, file=sys.stderr)
 
 forecasts_file = configParser.get("Main", "forecasts_file")
 
+forecasts_records = records.get_records_many(os.path.join(options.directory, forecasts_file), eligible_codes, as_of=ref_timestamp)
+
 toDelete = []
 for code in eligible_codes:
-    forecasts = get_latest_forecasts(os.path.join(options.directory, forecasts_file), code)
+    forecasts = get_latest_forecasts(forecasts_records[code])
     tmp = []
     for key in sorted(forecasts, key=lambda x: x.financial_year):
         if code in all_fundamentals_dates:
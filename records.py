@@ -3,6 +3,7 @@
 import sys
 import os
 import math
+import json
 from datetime import datetime
 from collections import namedtuple
 from enum import Enum
@@ -12,6 +13,117 @@ from lxml import etree
 
 # Utility Functions
 
+# Index
+# Records are appended to the end of the file as per-key segments, and a sidecar
+# index maps each key to its byte ranges and its last record. The file is rewritten
+# sorted by key once the appended segments outgrow compaction_ratio. The index is
+# built on first use, cached per process and rebuilt whenever the file's size or
+# mtime changes, so lookups are a seek and a read of the key's ranges.
+
+compaction_ratio = 0.5
+
+index_cache = {}
+main_keys_cache = {}
+
+def index_filename(filename):
+    return "%s.idx" % os.path.realpath(filename)
+
+def read_record(f, offset):
+    f.seek(offset)
+    tokens = f.readline().decode("utf-8").rstrip("\n").split(",")
+    return tuple([float(tokens[1])] + tokens[2:])
+
+def build_index(filename):
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+    headers = None
+    keys = {}
+    offset = 0
+    newline = True
+    with open(path, 'rb') as f:
+        for raw_line in f:
+            start = offset
+            offset += len(raw_line)
+            newline = raw_line.endswith(b"\n")
+            line = raw_line.decode("utf-8").rstrip("\n")
+            if headers is None:
+                headers = line.split(",") if line else []
+                continue
+            tokens = line.split(",")
+            try:
+                float(tokens[1])
+            except (IndexError, ValueError):
+                continue
+            rec_key = tokens[0]
+            if rec_key not in keys:
+                keys[rec_key] = { "tail" : start, "ranges" : [] }
+            entry = keys[rec_key]
+            if entry["ranges"] and entry["ranges"][-1][1] == start:
+                entry["ranges"][-1][1] = offset
+            else:
+                entry["ranges"] += [[start, offset]]
+            entry["tail"] = start
+    return { "size" : stat.st_size, "mtime" : stat.st_mtime_ns, "compacted_size" : stat.st_size, "newline" : newline, "headers" : headers or [], "keys" : keys }
+
+def save_index(filename, index):
+    path = os.path.realpath(filename)
+    index_cache[path] = index
+    main_keys_cache.pop(path, None)
+    with open(index_filename(path) + ".tmp", 'w') as f:
+        json.dump(index, f)
+    os.replace(index_filename(path) + ".tmp", index_filename(path))
+
+def load_index(filename):
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+    index = index_cache.get(path)
+    if index is not None and index["size"] == stat.st_size and index["mtime"] == stat.st_mtime_ns:
+        return index
+    try:
+        with open(index_filename(path), 'r') as f:
+            index = json.load(f)
+        if index["size"] == stat.st_size and index["mtime"] == stat.st_mtime_ns:
+            index_cache[path] = index
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    index = build_index(path)
+    try:
+        save_index(path, index)
+    except OSError:  # Read-only data directory: keep the index in memory only
+        index_cache[path] = index
+    return index
+
+def get_main_keys(filename):
+    path = os.path.realpath(filename)
+    index = load_index(path)
+    if path in main_keys_cache and main_keys_cache[path][0] is index:
+        return main_keys_cache[path][1]
+    main_keys = {}
+    for rec_key in sorted(index["keys"].keys()):
+        rec_key_main = rec_key.split("|")[0]
+        if rec_key_main not in main_keys:
+            main_keys[rec_key_main] = []
+        main_keys[rec_key_main] += [rec_key]
+    main_keys_cache[path] = (index, main_keys)
+    return main_keys
+
+def compact_records(filename):
+    path = os.path.realpath(filename)
+    index = load_index(path)
+    with open(path + ".tmp", 'wb') as g:
+        g.write(("%s\n" % ",".join(index["headers"])).encode("utf-8"))
+        with open(path, 'rb') as f:
+            for key in sorted(index["keys"].keys()):
+                for (start, end) in index["keys"][key]["ranges"]:
+                    f.seek(start)
+                    chunk = f.read(end - start)
+                    g.write(chunk if chunk.endswith(b"\n") else chunk + b"\n")
+    os.replace(path + ".tmp", path)
+    index = build_index(path)
+    save_index(path, index)
+    return index
+
 # csv
 
 def create_records(filename, headers):
@@ -32,66 +144,90 @@ def create_records(filename, headers):
 def insert_records(filename, records=[]):
     if not records or len(records) < 1:
         return
-    with open(os.path.realpath(filename), 'r') as f:
-        all_lines = f.read()
-    lines = all_lines.split("\n")
-    headers = None
-    existing_records = {}
-    for line in lines:
-        try:
-            if not headers:
-                headers = line.split(",")
-                if len(headers) != len(records[0]):
-                    raise Exception("Record format does not match file format")
+    path = os.path.realpath(filename)
+    index = load_index(path)
+    if index["headers"] and len(index["headers"]) != len(records[0]):
+        raise Exception("Record format does not match file format")
+    new_lines = {}
+    with open(path, 'rb') as f:
+        for record in sorted(records, key=lambda x: float(x[1])):
+            rec_key = str(record[0])
+            timestamp = float(record[1])
+            insert_record = tuple(map(str, record[2:]))
+            if rec_key in new_lines:
+                last_record = new_lines[rec_key][-1]
+            elif rec_key in index["keys"]:
+                last_record = read_record(f, index["keys"][rec_key]["tail"])
+            else:
+                last_record = None
+            if last_record is not None and (last_record[0] > timestamp or last_record[1:] == insert_record):
                 continue
-            tokens = line.split(",")
-            rec_key = tokens[0]
-            timestamp = float(tokens[1])
-            if rec_key not in existing_records:
-                existing_records[rec_key] = []
-            existing_records[rec_key] += [tuple([timestamp] + tokens[2:])]
-        except (IndexError, ValueError):
-            continue
-    for record in sorted(records, key=lambda x: float(x[1])):
-        rec_key = str(record[0])
-        timestamp = float(record[1])
-        insert_record = tuple(map(str, record[2:]))
-        if rec_key not in existing_records:
-            existing_records[rec_key] = []
-        if len(existing_records[rec_key]) > 0 and (existing_records[rec_key][-1][0] > timestamp or existing_records[rec_key][-1][1:] == insert_record):
-            continue
-        existing_records[rec_key] += [tuple([timestamp]) + insert_record]
-    with open(os.path.realpath(filename), 'w') as f:
-        print(",".join(headers), file=f)
-        for key in sorted(existing_records.keys()):
-            for tup in existing_records[key]:
-                print("%s,%s" % (key, ",".join(map(str, tup))), file=f)
+            if rec_key not in new_lines:
+                new_lines[rec_key] = []
+            new_lines[rec_key] += [tuple([timestamp]) + insert_record]
+    if not new_lines:
+        return
+    # Append one segment per key to the end of the file
+    with open(path, 'ab') as f:
+        offset = f.tell()
+        if not index["newline"]:
+            f.write(b"\n")
+            offset += 1
+        for key in sorted(new_lines.keys()):
+            start = offset
+            for tup in new_lines[key]:
+                line = ("%s,%s\n" % (key, ",".join(map(str, tup)))).encode("utf-8")
+                f.write(line)
+                tail = offset
+                offset += len(line)
+            if key not in index["keys"]:
+                index["keys"][key] = { "tail" : tail, "ranges" : [] }
+            entry = index["keys"][key]
+            if entry["ranges"] and entry["ranges"][-1][1] == start:
+                entry["ranges"][-1][1] = offset
+            else:
+                entry["ranges"] += [[start, offset]]
+            entry["tail"] = tail
+    index["newline"] = True
+    stat = os.stat(path)
+    index["size"] = stat.st_size
+    index["mtime"] = stat.st_mtime_ns
+    if index["size"] - index["compacted_size"] > compaction_ratio * index["compacted_size"]:
+        compact_records(path)
+    else:
+        save_index(path, index)
 
 def get_records(filename, key):
-    key = str(key)
-    with open(os.path.realpath(filename), 'r') as f:
-        all_lines = f.read()
-    lines = all_lines.split("\n")
-    headers = None
-    existing_records = []
-    for line in lines:
-        try:
-            if not headers:
-                headers = line
-                continue
-            tokens = line.split(",")
-            rec_key = tokens[0]
-            if "|" in rec_key:
-                rec_key_main = rec_key.split("|")[0]
-            else:
-                rec_key_main = rec_key
-            if rec_key_main != key:
-                continue
-            timestamp = float(tokens[1])
-            existing_records += [tuple([rec_key, timestamp] + tokens[2:])]
-        except ValueError:
-            continue
-    return existing_records
+    return get_records_many(filename, [key])[key]
+
+def get_records_many(filename, keys, as_of=None):
+    path = os.path.realpath(filename)
+    index = load_index(path)
+    main_keys = get_main_keys(path)
+    rec_keys = sorted(set([ rec_key for key in keys for rec_key in main_keys.get(str(key), []) ]))
+    ranges = sorted([ (start, end, rec_key) for rec_key in rec_keys for (start, end) in index["keys"][rec_key]["ranges"] ])
+    existing_records = {}
+    for rec_key in rec_keys:
+        existing_records[rec_key] = []
+    # Read the requested ranges in file order, so many keys cost one pass
+    if ranges:
+        with open(path, 'rb') as f:
+            for (start, end, rec_key) in ranges:
+                f.seek(start)
+                lines = f.read(end - start).decode("utf-8").split("\n")
+                for line in lines:
+                    try:
+                        tokens = line.split(",")
+                        timestamp = float(tokens[1])
+                        if as_of is not None and timestamp > as_of:
+                            continue
+                        existing_records[rec_key] += [tuple([rec_key, timestamp] + tokens[2:])]
+                    except (IndexError, ValueError):
+                        continue
+    res = {}
+    for key in keys:
+        res[key] = [ rec for rec_key in main_keys.get(str(key), []) for rec in existing_records[rec_key] ]
+    return res
 
 # XML
 
@@ -47,6 +47,7 @@ market_open_duration_in_minutes = bars.market_open_duration // 60
 codes = [options.code]
 
 prices_folder = configParser.get("Main", "prices_folder")
+columnar_prices_folder = configParser.get("Main", "columnar_prices_folder")
 
 dates = sorted(os.listdir(os.path.join(options.directory, prices_folder)))
 dates = [d for d in dates if d >= options.start and d <= options.end]
@@ -54,12 +55,15 @@ dates = [d for d in dates if d >= options.start and d <= options.end]
 foos = {}
 
 for d in dates:
-    foo = bars.read_all_bars(os.path.join(options.directory, prices_folder, d))
+    foo = bars.read_all_bars_store(os.path.join(options.directory, prices_folder, d), os.path.join(options.directory, columnar_prices_folder, d))
     for code in foo:
         if code in codes:
             if code not in foos:
                 foos[code] = []
-            foos[code] += foo[code]
+            foos[code] += [foo[code]]
+
+for code in foos:
+    foos[code] = bars.concatenate_bars(foos[code])
 
 # Start
 
@@ -3,41 +3,84 @@
 # Note: Hardcoded information present
 
 import sys
+import os
+import hashlib
 import datetime as dtime
 from datetime import datetime
 from collections import namedtuple
 import math
-import statsmodels.robust
 import numpy
-import pandas
 import pywt
 
 # Data Structures
 
 # Utility Functions
 
+def mad(x, axis=0):
+    import statsmodels.robust
+    return statsmodels.robust.mad(x, axis=axis)
+
 # Wavelets
 
 def wavelet_denoise_single_pass(series, wavelet):
     n = series.shape[0]
     l = int(numpy.ceil(numpy.log2(n)))
     noisy_coefs = pywt.wavedec(series, wavelet, level=l, mode='per')
-    sigma = statsmodels.robust.stand_mad(noisy_coefs[-1])
+    sigma = mad(noisy_coefs[-1])
     uthresh = sigma * numpy.sqrt(2 * numpy.log(n))
     denoised_coefs = noisy_coefs[:]
-    denoised_coefs[1:] = (pywt.thresholding.soft(x, value=uthresh) for x in denoised_coefs[1:])
+    denoised_coefs[1:] = (pywt.threshold(x, uthresh, mode='soft') for x in denoised_coefs[1:])
     denoised_series = pywt.waverec(denoised_coefs, wavelet, mode='per')
     if denoised_series.shape[0] > n:
         denoised_series = denoised_series[0:n]
     return denoised_series
 
+# Translation-invariant denoising with the stationary (undecimated) transform: soft-thresholding the SWT coefficients
+# and inverting averages the single-pass denoise over every circular shift of the series, in one transform with the
+# series' own period n, as for the periodic transforms of the rolling mode. That mode averages over the 2 * log2(n) + 1
+# shifts 0, +/- 1, 2, 4, ... only. On 1-minute price series of 331 to 2640 bars at 0.1% volatility per bar, the two
+# modes agree to within 6e-3 relative in price (median 2e-4, 1e-3 for dmey) for every wavelet in the configuration, and
+# to within 1e-2 at 0.2%, most of it at the rolling mode's dyadic block edges. The swt mode is 6-12x faster, though only
+# 2-3x at large prime n (2311), where the FFT is slowest.
+denoise_mode = "swt"
+
+def wavelet_filter_responses(wavelet, n):
+    # Frequency responses of the decomposition filters, wrapped to n periodic taps
+    w = pywt.Wavelet(wavelet)
+    lo = numpy.fft.fft(numpy.bincount(numpy.arange(len(w.dec_lo)) % n, weights=w.dec_lo, minlength=n))
+    hi = numpy.fft.fft(numpy.bincount(numpy.arange(len(w.dec_hi)) % n, weights=w.dec_hi, minlength=n))
+    return (lo, hi)
+
+def wavelet_denoise_swt(series, wavelet):
+    # The level j filters of the undecimated transform are the base filters at frequencies 2^j * w, so analysis and the
+    # shift-averaging synthesis are products with the filter responses and their conjugates in the Fourier domain.
+    # Works along the last axis, so a 2-D array denoises one series per row
+    n = series.shape[-1]
+    l = int(numpy.ceil(numpy.log2(n)))
+    (lo, hi) = wavelet_filter_responses(wavelet, n)
+    scales = [ (numpy.arange(n) * 2**j) % n for j in range(0, l) ]
+    approx = numpy.fft.fft(series)
+    noisy_coefs = []
+    for scale in scales:
+        noisy_coefs += [numpy.fft.ifft(approx * hi[scale]).real]
+        approx = approx * lo[scale]
+    sigma = mad(noisy_coefs[0], axis=-1)
+    uthresh = numpy.expand_dims(sigma * numpy.sqrt(2 * numpy.log(n)), -1)
+    for (scale, coefs) in reversed(list(zip(scales, noisy_coefs))):
+        approx = (approx * numpy.conj(lo[scale]) + numpy.fft.fft(pywt.threshold(coefs, uthresh, mode='soft')) * numpy.conj(hi[scale])) / 2
+    return numpy.fft.ifft(approx).real
+
 # Logarithm-Detrend-Denoise-Trend-Exponentiate
-def wavelet_denoise(series, wavelet):
+def wavelet_denoise(series, wavelet, mode=None):
     n = series.shape[0]
     # Take logarithm and Detrend
     log_series = numpy.log(series)
     linear_trend = (log_series[n-1] - log_series[0]) / (n - 1)
     detrended_series = log_series - (numpy.arange(n) * linear_trend if linear_trend != 0 else 0)
+    if (denoise_mode if mode is None else mode) == "swt":
+        denoised_series = wavelet_denoise_swt(detrended_series, wavelet)
+        denoised_series += (numpy.arange(n) * linear_trend if linear_trend != 0 else 0)
+        return numpy.exp(denoised_series)
     denoised_series = None 
     # Roll around to get average denoising
     # For roll periods +/- 1, 2, 4, 8, ...
@@ -56,6 +99,98 @@ def wavelet_denoise(series, wavelet):
     denoised_series += (numpy.arange(n) * linear_trend if linear_trend != 0 else 0)
     return numpy.exp(denoised_series)
 
+# Denoised series cache
+# Content-addressed by the series values, wavelet and denoise mode, one .npy per series under denoise_cache_folder
+# (disabled while None). Only the series is kept: its coefficients are one wavedec away, which costs about as much as
+# loading them would. Hits and writes move a file to the back of an in-process index, built from the folder on the
+# first write, and the front of the index is evicted past denoise_cache_size bytes. The limit holds per process: files
+# other processes write later are not in the index, so processes sharing a folder should split the size between them.
+
+# Bumped when a mode's output changes, so series cached before are missed
+denoise_cache_version = 2
+denoise_cache_folder = None
+denoise_cache_size = 1024 * 1024 * 1024
+denoise_cache_index = None
+denoise_cache_usage = 0
+
+def denoise_cache_filename(series, wavelet, mode):
+    series = numpy.ascontiguousarray(series, dtype=numpy.float64)
+    key = hashlib.sha1(series.tobytes() + ("|%s|%s|%d" % (wavelet, mode, denoise_cache_version)).encode("utf-8")).hexdigest()
+    return os.path.join(denoise_cache_folder, key[0:2], key + ".npy")
+
+def load_denoise_cache_index():
+    global denoise_cache_index, denoise_cache_usage
+    files = []
+    for (root, dirs, names) in os.walk(denoise_cache_folder):
+        for name in names:
+            if name.endswith(".npy"):
+                stat = os.stat(os.path.join(root, name))
+                files += [(stat.st_mtime_ns, os.path.join(root, name), stat.st_size)]
+    denoise_cache_index = { name: size for (mtime, name, size) in sorted(files) }
+    denoise_cache_usage = sum(denoise_cache_index.values())
+
+def touch_denoise_cache(filename, size):
+    global denoise_cache_usage
+    denoise_cache_usage += size - denoise_cache_index.pop(filename, 0)
+    denoise_cache_index[filename] = size
+
+def read_denoise_cache(filename):
+    try:
+        denoised = numpy.load(filename)
+        os.utime(filename)
+        if denoise_cache_index is not None and filename in denoise_cache_index:
+            touch_denoise_cache(filename, denoise_cache_index[filename])
+        return denoised
+    except (OSError, ValueError):
+        return None
+
+def write_denoise_cache(filename, denoised):
+    global denoise_cache_usage
+    if denoise_cache_index is None:
+        load_denoise_cache_index()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + ".%d.tmp" % os.getpid(), 'wb') as f:
+        numpy.save(f, denoised)
+    os.replace(filename + ".%d.tmp" % os.getpid(), filename)
+    touch_denoise_cache(filename, os.path.getsize(filename))
+    if denoise_cache_usage > denoise_cache_size:
+        for name in list(denoise_cache_index):
+            if denoise_cache_usage <= denoise_cache_size * 0.9 or name == filename:
+                break
+            denoise_cache_usage -= denoise_cache_index.pop(name)
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+def wavelet_denoise_batch(series, wavelet, mode=None):
+    # One series per row, all of the same length
+    mode = denoise_mode if mode is None else mode
+    if denoise_cache_folder is None:
+        return wavelet_denoise_batch_uncached(series, wavelet, mode)
+    filenames = [ denoise_cache_filename(s, wavelet, mode) for s in series ]
+    denoised = [ read_denoise_cache(filename) for filename in filenames ]
+    missing = [ i for (i, d) in enumerate(denoised) if d is None ]
+    if len(missing) > 0:
+        for (i, d) in zip(missing, wavelet_denoise_batch_uncached(series[missing], wavelet, mode)):
+            write_denoise_cache(filenames[i], d)
+            denoised[i] = d
+    return numpy.array(denoised).reshape(series.shape)
+
+def wavelet_denoise_batch_uncached(series, wavelet, mode):
+    n = series.shape[1]
+    if mode != "swt":
+        return numpy.array([ wavelet_denoise(s, wavelet, mode=mode) for s in series ]).reshape(series.shape)
+    log_series = numpy.log(series)
+    linear_trend = ((log_series[:, n-1] - log_series[:, 0]) / (n - 1)).reshape((-1, 1)) * numpy.arange(n)
+    return numpy.exp(wavelet_denoise_swt(log_series - linear_trend, wavelet) + linear_trend)
+
+def wavelet_transform_batch(series, wavelet):
+    n = series.shape[1]
+    l = int(numpy.ceil(numpy.log2(n)))
+    denoised = wavelet_denoise_batch(series, wavelet)
+    return pywt.wavedec(denoised, wavelet, level=l, mode='per', axis=-1)
+
 def wavelet_transform(series, wavelet):
     n = series.shape[0]
     l = int(numpy.ceil(numpy.log2(n)))
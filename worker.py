@@ -1,8 +1,19 @@
 #!/bin/env python3
 
 import sys
+import time
+import random
+import heapq
+import copy
+import inspect
+import queue
+import threading
+import asyncio
 import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from collections import namedtuple
 from enum import Enum
+import numpy
 
 # Enum
 
@@ -10,8 +21,112 @@ class ExceptionHandling(Enum):
     IGNORE = "IGNORE"
     THROW = "THROW"
 
+class Backend(Enum):
+    PROCESS = "PROCESS"  # CPU-bound tasks, one process per worker
+    THREAD = "THREAD"  # Blocking I/O, one thread per worker
+    ASYNCIO = "ASYNCIO"  # Up to n tasks at a time on one event loop: coroutines directly, blocking calls on n threads
+
+# Data Structures
+
+SharedArray = namedtuple("SharedArray", ["name", "shape", "dtype"])
+
+# Utility Functions
+
+# Arrays inside tuples, lists and dicts are found recursively; anything else is left to pickling
+
+def map_arrays(obj, f):
+    if isinstance(obj, (numpy.ndarray, SharedArray)):
+        return f(obj)
+    elif isinstance(obj, tuple):
+        items = [ map_arrays(x, f) for x in obj ]
+        return type(obj)(*items) if hasattr(obj, "_fields") else type(obj)(items)
+    elif isinstance(obj, list):
+        return [ map_arrays(x, f) for x in obj ]
+    elif isinstance(obj, dict):
+        return { k: map_arrays(v, f) for (k, v) in obj.items() }
+    return obj
+
+def share_arrays(obj, min_bytes):
+    # Numeric arrays of at least min_bytes are copied into new shared memory blocks and replaced by their handles.
+    # Smaller views are copied too, so nothing returned can point into a block that is about to be closed
+    def share(x):
+        if not isinstance(x, numpy.ndarray):
+            return x
+        elif x.nbytes < min_bytes or x.dtype.hasobject:
+            return x if x.base is None else x.copy()
+        block = shared_memory.SharedMemory(create=True, size=max(x.nbytes, 1))
+        numpy.ndarray(x.shape, dtype=x.dtype, buffer=block.buf)[...] = x
+        block.close()
+        return SharedArray(block.name, x.shape, x.dtype.str)
+    return map_arrays(obj, share)
+
+def attach_arrays(obj, blocks):
+    # Zero-copy views of the shared blocks, which are appended to blocks for the caller to release
+    def attach(x):
+        if not isinstance(x, SharedArray):
+            return x
+        block = shared_memory.SharedMemory(name=x.name)
+        blocks.append(block)
+        return numpy.ndarray(x.shape, dtype=numpy.dtype(x.dtype), buffer=block.buf)
+    return map_arrays(obj, attach)
+
+def receive_arrays(obj):
+    # Private copies of the shared arrays, whose blocks are then unlinked
+    def receive(x):
+        if not isinstance(x, SharedArray):
+            return x
+        block = shared_memory.SharedMemory(name=x.name)
+        try:
+            return numpy.ndarray(x.shape, dtype=numpy.dtype(x.dtype), buffer=block.buf).copy()
+        finally:
+            block.close()
+            block.unlink()
+    return map_arrays(obj, receive)
+
+def release_blocks(blocks):
+    for block in blocks:
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+        try:
+            block.close()
+        except BufferError:  # Still exported; the mapping goes with its last view
+            pass
+
+def unlink_arrays(obj):
+    blocks = []
+    attach_arrays(obj, blocks)
+    release_blocks(blocks)
+
 # Utility Class
 
+def run_tasks(task_queue, result_queue, exception_handling):
+    while True:
+        try:
+            next_task = task_queue.get()
+            if not next_task:
+#                print("%s Poisoned" % multiprocessing.current_process().name, file=sys.stderr)
+                task_queue.task_done()
+                break
+            try:
+                result = next_task()
+                result_queue.put(result)
+            except Exception as e:
+                if exception_handling == ExceptionHandling.IGNORE:
+#                    print("%s Exception: %s" % (multiprocessing.current_process().name, e), file=sys.stderr)
+#                    print("%s IGNORE error" % multiprocessing.current_process().name, file=sys.stderr)
+                    pass
+                elif exception_handling == ExceptionHandling.THROW:  # Caution
+                    task_queue.task_done()
+                    raise e
+                else:  # Special Token
+                    result_queue.put(exception_handling)
+            task_queue.task_done()
+        except Exception as e:
+            raise e
+            pass
+
 class Worker(multiprocessing.Process):
     def __init__(self, task_queue, result_queue, exception_handling=ExceptionHandling.IGNORE):
         multiprocessing.Process.__init__(self)
@@ -19,37 +134,99 @@ class Worker(multiprocessing.Process):
         self.result_queue = result_queue
         self.exception_handling = exception_handling
     def run(self):
-        while True:
+        run_tasks(self.task_queue, self.result_queue, self.exception_handling)
+
+class ThreadWorker(threading.Thread):
+    def __init__(self, task_queue, result_queue, exception_handling=ExceptionHandling.IGNORE):
+        threading.Thread.__init__(self, daemon=True)
+        self.task_queue = task_queue
+        self.result_queue = result_queue
+        self.exception_handling = exception_handling
+    def run(self):
+        run_tasks(self.task_queue, self.result_queue, self.exception_handling)
+
+def run_in_daemon_thread(loop, f):
+    # Like loop.run_in_executor, but on a daemon thread, so a call still blocked at shutdown does not hold up the exit
+    future = loop.create_future()
+    def resolve(result, exception):
+        if not future.done():
+            future.set_exception(exception) if exception is not None else future.set_result(result)
+    def call():
+        try:
+            (result, exception) = (f(), None)
+        except Exception as e:
+            (result, exception) = (None, e)
+        try:
+            loop.call_soon_threadsafe(resolve, result, exception)
+        except RuntimeError:  # The loop has closed
+            pass
+    threading.Thread(target=call, daemon=True).start()
+    return future
+
+class AsyncioWorker(ThreadWorker):
+    # One thread running an event loop, which takes a task off the queue whenever fewer than n are running. Blocking
+    # tasks run on a daemon thread each, so at most n at a time
+    def __init__(self, task_queue, result_queue, n, exception_handling=ExceptionHandling.IGNORE):
+        ThreadWorker.__init__(self, task_queue, result_queue, exception_handling)
+        self.n = n
+    def run(self):
+        asyncio.run(self.serve())
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.n)
+        running = set()
+        errors = []
+        def finished(future):
+            running.discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                errors.append(future.exception())
+        while len(errors) == 0:
+            await semaphore.acquire()
             try:
-                next_task = self.task_queue.get()
-                if not next_task:
-#                    print("%s Poisoned" % multiprocessing.current_process().name, file=sys.stderr)
-                    self.task_queue.task_done()
-                    break
-                try:
-                    result = next_task()
-                    self.result_queue.put(result)
-                except Exception as e:
-                    if self.exception_handling == ExceptionHandling.IGNORE:
-#                        print("%s Exception: %s" % (multiprocessing.current_process().name, e), file=sys.stderr)
-#                        print("%s IGNORE error" % multiprocessing.current_process().name, file=sys.stderr)
-                        pass
-                    elif self.exception_handling == ExceptionHandling.THROW:  # Caution
-                        self.task_queue.task_done()
-                        raise e
-                    else:  # Special Token
-                        self.result_queue.put(self.exception_handling)
+                next_task = self.task_queue.get_nowait()
+            except queue.Empty:
+                next_task = await run_in_daemon_thread(loop, self.task_queue.get)
+            if not next_task:
                 self.task_queue.task_done()
-            except Exception as e:
+                break
+            future = asyncio.ensure_future(self.execute(next_task, semaphore))
+            running.add(future)
+            future.add_done_callback(finished)
+        await asyncio.gather(*running)
+        if len(errors) > 0:  # Only with ExceptionHandling.THROW; ends the worker like a raising process
+            raise errors[0]
+    async def execute(self, next_task, semaphore):
+        try:
+            if inspect.iscoroutinefunction(next_task) or inspect.iscoroutinefunction(getattr(next_task, "__call__", None)):
+                result = await next_task()
+            else:
+                result = await run_in_daemon_thread(asyncio.get_running_loop(), next_task)
+            self.result_queue.put(result)
+        except Exception as e:
+            if self.exception_handling == ExceptionHandling.THROW:  # Caution
                 raise e
-                pass
+            elif self.exception_handling != ExceptionHandling.IGNORE:  # Special Token
+                self.result_queue.put(self.exception_handling)
+        finally:
+            self.task_queue.task_done()
+            semaphore.release()
 
 class WorkerPool:
-    def __init__(self, n, exception_handling=ExceptionHandling.IGNORE):
+    def __init__(self, n, exception_handling=ExceptionHandling.IGNORE, backend=Backend.PROCESS):
         self.n = n
-        self.task_queue = multiprocessing.JoinableQueue()
-        self.result_queue = multiprocessing.Queue()
-        self.workers = [ Worker(self.task_queue, self.result_queue) for i in range(0, n) ]
+        self.backend = backend
+        if backend == Backend.PROCESS:
+            self.task_queue = multiprocessing.JoinableQueue()
+            self.result_queue = multiprocessing.Queue()
+            self.workers = [ Worker(self.task_queue, self.result_queue, exception_handling) for i in range(0, n) ]
+        elif backend == Backend.THREAD:
+            self.task_queue = queue.Queue()
+            self.result_queue = queue.Queue()
+            self.workers = [ ThreadWorker(self.task_queue, self.result_queue, exception_handling) for i in range(0, n) ]
+        else:
+            self.task_queue = queue.Queue()
+            self.result_queue = queue.Queue()
+            self.workers = [ AsyncioWorker(self.task_queue, self.result_queue, n, exception_handling) ]
         self.started = False
     def start(self):
         if not self.started:
@@ -59,19 +236,22 @@ class WorkerPool:
     def terminate(self, timeout=None):
         while not self.task_queue.empty():
             self.task_queue.get()
-        for i in range(0, self.n):
+        for i in range(0, len(self.workers)):
             self.task_queue.put(None)
         if not timeout:
             for w in self.workers:
                 w.join()
         else:
+            deadline = time.monotonic() + timeout
             for w in self.workers:
-                w.join(timeout)
-            for w in self.workers:
-                w.terminate()
-                w.join()
+                w.join(max(deadline - time.monotonic(), 0))
+            if self.backend == Backend.PROCESS:
+                for w in self.workers:
+                    w.terminate()
+                    w.join()
+            # Worker threads still running a task past the timeout are abandoned; they are daemons
     def health_check(self):
-        return sum((1 if w.is_alive else 0 for w in self.workers))
+        return sum((1 if w.is_alive() else 0 for w in self.workers))
     def put(self, task):
         self.task_queue.put(task)
         if not self.started:
@@ -79,6 +259,113 @@ class WorkerPool:
     def get(self, timeout=None):
         return self.result_queue.get(timeout=timeout)
 
+# Shared memory variant for tasks and results carrying large numpy arrays. put copies the arrays among a task's
+# attributes into shared memory once, the worker attaches them without copying and releases them when the task returns.
+# Arrays in results come back the same way and get copies them out. Smaller arrays are pickled as before.
+
+class SharedMemoryTask(object):
+    def __init__(self, task, min_bytes):
+        self.task = task
+        self.min_bytes = min_bytes
+    def __call__(self):
+        blocks = []
+        try:
+            task = self.task
+            if hasattr(task, "__dict__"):
+                task = copy.copy(task)
+                task.__dict__ = attach_arrays(self.task.__dict__, blocks)
+            return share_arrays(task(), self.min_bytes)
+        finally:
+            task = None
+            release_blocks(blocks)
+    def release(self):
+        if hasattr(self.task, "__dict__"):
+            unlink_arrays(self.task.__dict__)
+
+class SharedMemoryWorkerPool(WorkerPool):
+    def __init__(self, n, exception_handling=ExceptionHandling.IGNORE, min_bytes=65536):
+        WorkerPool.__init__(self, n, exception_handling)
+        self.min_bytes = min_bytes
+    def start(self):
+        # One resource tracker for the pool, so blocks created on either side are unregistered by whichever side unlinks
+        resource_tracker.ensure_running()
+        WorkerPool.start(self)
+    def terminate(self, timeout=None):
+        while not self.task_queue.empty():
+            task = self.task_queue.get()
+            if task:
+                task.release()
+        WorkerPool.terminate(self, timeout)
+        while not self.result_queue.empty():
+            unlink_arrays(self.result_queue.get())
+    def put(self, task):
+        if hasattr(task, "__dict__"):
+            shared_task = copy.copy(task)
+            shared_task.__dict__ = share_arrays(task.__dict__, self.min_bytes)
+            task = shared_task
+        WorkerPool.put(self, SharedMemoryTask(task, self.min_bytes))
+    def get(self, timeout=None):
+        return receive_arrays(WorkerPool.get(self, timeout))
+
+# Retries
+# Wraps a pool so that a stage ends in bounded time: tasks start at most host_rate per second per host, a failed task
+# is put again after an exponential backoff with jitter, and after max_attempts attempts its key becomes a dead letter.
+
+class RetryPool(object):
+    def __init__(self, pool, max_attempts=5, base_delay=1.0, max_delay=60.0, host_rate=None):
+        self.pool = pool
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.host_rate = host_rate
+        self.tasks = {}  # key -> (task, host, attempts)
+        self.scheduled = []  # Heap of (due, sequence, key)
+        self.sequence = 0
+        self.host_slots = {}
+        self.dead_letters = []
+    def schedule(self, key, due):
+        (task, host, attempts) = self.tasks[key]
+        if self.host_rate:
+            due = max(due, self.host_slots.get(host, due))
+            self.host_slots[host] = due + 1.0 / self.host_rate
+        heapq.heappush(self.scheduled, (due, self.sequence, key))
+        self.sequence += 1
+    def release(self):
+        now = time.monotonic()
+        while len(self.scheduled) > 0 and self.scheduled[0][0] <= now:
+            (due, sequence, key) = heapq.heappop(self.scheduled)
+            (task, host, attempts) = self.tasks[key]
+            self.tasks[key] = (task, host, attempts + 1)
+            self.pool.put(task)
+    def start(self):
+        self.pool.start()
+    def terminate(self, timeout=None):
+        self.pool.terminate(timeout)
+    def put(self, task, key, host=None):
+        self.tasks[key] = (task, host, 0)
+        self.schedule(key, time.monotonic())
+        self.release()
+    def retry(self, key):
+        # False once the key has used up its attempts
+        (task, host, attempts) = self.tasks[key]
+        if attempts >= self.max_attempts:
+            self.dead_letters += [(key, attempts)]
+            return False
+        self.schedule(key, time.monotonic() + min(self.max_delay, self.base_delay * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0))
+        return True
+    def get(self, timeout=None):
+        # Puts due tasks while waiting, so retries and rate-limited tasks start on time
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self.release()
+            now = time.monotonic()
+            waits = ([deadline - now] if deadline is not None else []) + ([self.scheduled[0][0] - now] if len(self.scheduled) > 0 else [])
+            try:
+                return self.pool.get(timeout=max(min(waits), 0) if len(waits) > 0 else None)
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+
 # Example Task
 
 class Task(object):
@@ -5,21 +5,50 @@
 import sys
 import os
 from enum import Enum
+from collections import namedtuple
+from multiprocessing import shared_memory, resource_tracker
 import numpy
-import scipy.stats
-import theano.tensor as T
-from theano import function, Param
 
 import bars
 
+# Optional kernels
+# Nothing heavier than numpy loads with this module. Set XS_BACKEND=numba to have @kernel functions compiled on their
+# first call, otherwise (or if numba is missing) their numpy fallbacks run. scipy.stats is likewise imported on first use.
+
+kernel_backend = os.environ.get("XS_BACKEND", "numpy")
+backend_modules = {}
+kernels = {}
+
+def load_backend():
+    if kernel_backend not in backend_modules:
+        backend_modules[kernel_backend] = None
+        if kernel_backend == "numba":
+            try:
+                import numba
+                backend_modules[kernel_backend] = numba
+            except ImportError:
+                print("xs: numba is not installed, using the numpy kernels", file=sys.stderr)
+    return backend_modules[kernel_backend]
+
+def kernel(fallback):
+    def register(f):
+        def call(*args):
+            if f not in kernels:
+                backend = load_backend()
+                kernels[f] = backend.njit(cache=True)(f) if backend is not None else fallback
+            return kernels[f](*args)
+        return call
+    return register
+
+def f_cdf(x, dfn, dfd):
+    import scipy.stats
+    return scipy.stats.f.cdf(x, dfn, dfd)
+
 # Shorthands
 
-def get_volatility(bars):
-    bar_os = numpy.log(numpy.array([bar.px_open for bar in bars]))
-    bar_us = numpy.log(numpy.array([bar.px_high for bar in bars]))
-    bar_ds = numpy.log(numpy.array([bar.px_low for bar in bars]))
-    bar_cs = numpy.log(numpy.array([bar.px_last for bar in bars]))
-    return get_volatility_ohlc(bar_os, bar_us, bar_ds, bar_cs)
+def get_volatility(foo):
+    foo = bars.to_bar_array(foo)
+    return get_volatility_ohlc(numpy.log(foo.px_open), numpy.log(foo.px_high), numpy.log(foo.px_low), numpy.log(foo.px_last))
 
 def get_volatility_ohlc(bar_os, bar_us, bar_ds, bar_cs):
     os = bar_os - numpy.concatenate((bar_os[0:1], bar_cs[:-1]))
@@ -32,6 +61,57 @@ def get_volatility_ohlc(bar_os, bar_us, bar_ds, bar_cs):
     k = 0.34 / (1.34 + float(len(os) + 1) / float(len(os) - 1))
     return vo + k * vc + (1 - k) * vrs
 
+def get_volatility_batch(foos, window=None):
+    foos = [ bars.to_bar_array(foo) for foo in foos ]
+    lengths = numpy.array([ len(foo) for foo in foos ], dtype=numpy.int64)
+    ohlc = numpy.full((4, len(foos), max(lengths.max(), 1) if len(foos) > 0 else 1), numpy.nan)
+    for (i, foo) in enumerate(foos):
+        for (j, field) in enumerate(["px_open", "px_high", "px_low", "px_last"]):
+            ohlc[j, i, :lengths[i]] = numpy.log(foo[field])
+    return get_volatility_ohlc_batch(ohlc[0], ohlc[1], ohlc[2], ohlc[3], lengths=lengths, window=window)
+
+def get_volatility_ohlc_batch(bar_os, bar_us, bar_ds, bar_cs, lengths=None, window=None):
+    # One series per row, padded at the end with NaN or cut to lengths. Returns one estimate per row, or with window the
+    # estimate over the window bars ending at each bar (NaN before the first full window or past the row's length)
+    bar_os = numpy.atleast_2d(numpy.asarray(bar_os, dtype=numpy.float64))
+    bar_us = numpy.atleast_2d(numpy.asarray(bar_us, dtype=numpy.float64))
+    bar_ds = numpy.atleast_2d(numpy.asarray(bar_ds, dtype=numpy.float64))
+    bar_cs = numpy.atleast_2d(numpy.asarray(bar_cs, dtype=numpy.float64))
+    (m, l) = bar_cs.shape
+    lengths = numpy.sum(~numpy.isnan(bar_cs), axis=1) if lengths is None else numpy.asarray(lengths, dtype=numpy.int64)
+    valid = numpy.arange(l) < lengths.reshape((m, 1))
+    os = numpy.where(valid, bar_os - numpy.concatenate((bar_os[:, 0:1], bar_cs[:, :-1]), axis=1), 0.0)
+    us = numpy.where(valid, bar_us - bar_os, 0.0)
+    ds = numpy.where(valid, bar_ds - bar_os, 0.0)
+    cs = numpy.where(valid, bar_cs - bar_os, 0.0)
+    rs = us * (us - cs) + ds * (ds - cs)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        if window is None:
+            n = lengths.astype(numpy.float64)
+            vo = numpy.sum(numpy.where(valid, os - (numpy.sum(os, axis=1) / n).reshape((m, 1)), 0.0) ** 2, axis=1) / (n - 1)
+            vc = numpy.sum(numpy.where(valid, cs - (numpy.sum(cs, axis=1) / n).reshape((m, 1)), 0.0) ** 2, axis=1) / (n - 1)
+            vrs = numpy.sum(rs, axis=1) / n
+        else:
+            # Window sums from prefix sums; each window's first overnight return is zero, as for a sliced series
+            n = float(window)
+            sums = lambda x: numpy.concatenate((numpy.zeros((m, 1)), numpy.cumsum(x, axis=1)), axis=1)
+            (o1, o2, c1, c2, r1) = (sums(os), sums(os * os), sums(cs), sums(cs * cs), sums(rs))
+            end = numpy.arange(window, l + 1)
+            start = end - window
+            so1 = o1[:, end] - o1[:, start + 1]
+            so2 = o2[:, end] - o2[:, start + 1]
+            sc1 = c1[:, end] - c1[:, start]
+            sc2 = c2[:, end] - c2[:, start]
+            vo = numpy.full((m, l), numpy.nan)
+            vc = numpy.full((m, l), numpy.nan)
+            vrs = numpy.full((m, l), numpy.nan)
+            vo[:, window - 1:] = (so2 - so1 ** 2 / n) / (n - 1)
+            vc[:, window - 1:] = (sc2 - sc1 ** 2 / n) / (n - 1)
+            vrs[:, window - 1:] = (r1[:, end] - r1[:, start]) / n
+            vo[~valid] = numpy.nan
+        k = 0.34 / (1.34 + (n + 1) / (n - 1))
+        return numpy.where(n > 1, vo + k * vc + (1 - k) * vrs, numpy.nan)
+
 # Static matrices
 
 def nmat(n):
@@ -43,42 +123,418 @@ def n1mat(n):
 def kmat(n):
     return 0.34 / (1.34 + numpy.cumsum(1 - numpy.tri(n, dtype=bool) + 2 * numpy.diag(numpy.ones(n)), axis=1) / numpy.cumsum(1 - numpy.tri(n, dtype=bool), axis=1))
 
+def trimat(n):
+    return numpy.tri(n, dtype=bool)
+
+def strict_trimat(n):
+    return numpy.tri(n, k=-1, dtype=bool)
+
+# The same entries for any (i, j), for the lazy window matrices below
+
+def nwindow(i, j):
+    return numpy.where(j >= i, j - i + 1, 0)
+
+def n1window(i, j):
+    return numpy.where(j > i, j - i, 0)
+
+def kwindow(i, j):
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return 0.34 / (1.34 + numpy.where(j >= i, j - i + 2, 0) / n1window(i, j))
+
+def triwindow(i, j):
+    return j <= i
+
+def strict_triwindow(i, j):
+    return j < i
+
+# Static matrix cache
+# Read-only and shared by every series of the same length, least recently used first out once the matrices held pass
+# matrix_cache_size bytes (XS_MATRIX_CACHE_SIZE, 256MB by default). A process can publish its copies with
+# share_static_matrices for the processes it starts to map with attach_static_matrices. The blocks it shares count
+# against its limit and stay until release_static_matrices, and only the sharing process unlinks them, once every
+# process is done with them. Blocks mapped from another process are not counted again.
+
+static_matrices = { "nmat": nmat, "n1mat": n1mat, "kmat": kmat, "tri": trimat, "strict_tri": strict_trimat }
+static_windows = { "nmat": nwindow, "n1mat": n1window, "kmat": kwindow, "tri": triwindow, "strict_tri": strict_triwindow }
+matrix_cache = {}
+matrix_cache_size = int(os.environ.get("XS_MATRIX_CACHE_SIZE", 256 * 1024 * 1024))
+shared_blocks = {}
+owned_blocks = set()
+
+def evict_static_matrices(nbytes):
+    # Drops the least recently used private matrices until nbytes more fit, and returns whether they do
+    private = [ key for key in matrix_cache if key not in shared_blocks ]
+    usage = sum([ matrix_cache[key].nbytes for key in private ]) + sum([ shared_blocks[key].size for key in owned_blocks ])
+    for key in private:
+        if usage + nbytes <= matrix_cache_size:
+            break
+        usage -= matrix_cache.pop(key).nbytes
+    return usage + nbytes <= matrix_cache_size
+
+def cache_static_matrix(key, matrix):
+    matrix.flags.writeable = False
+    matrix_cache.pop(key, None)
+    if key not in shared_blocks:
+        evict_static_matrices(matrix.nbytes)
+    matrix_cache[key] = matrix
+    return matrix
+
+def get_static_matrix(name, n):
+    key = (name, n)
+    matrix = matrix_cache.pop(key, None)
+    if matrix is None:
+        matrix = static_matrices[name](n)
+    return cache_static_matrix(key, matrix)
+
+def share_static_matrices(n, names=None):
+    descriptors = []
+    for name in (sorted(static_matrices) if names is None else names):
+        matrix = get_static_matrix(name, n)
+        if (name, n) not in shared_blocks:
+            matrix_cache.pop((name, n))
+            if not evict_static_matrices(matrix.nbytes):
+                raise MemoryError("Sharing %s for n = %d would pass matrix_cache_size (%d bytes)" % (name, n, matrix_cache_size))
+            block = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+            numpy.ndarray(matrix.shape, dtype=matrix.dtype, buffer=block.buf)[...] = matrix
+            shared_blocks[(name, n)] = block
+            owned_blocks.add((name, n))
+            # The block replaces the private copy
+            matrix = cache_static_matrix((name, n), numpy.ndarray(matrix.shape, dtype=matrix.dtype, buffer=block.buf))
+        descriptors += [(name, n, shared_blocks[(name, n)].name, matrix.shape, matrix.dtype.str)]
+    return descriptors
+
+def attach_static_matrices(descriptors):
+    for (name, n, block_name, shape, dtype) in descriptors:
+        if (name, n) not in shared_blocks:
+            shared_blocks[(name, n)] = attach_shared_memory(block_name)
+        cache_static_matrix((name, n), numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=shared_blocks[(name, n)].buf))
+
+def release_static_matrices(unlink=True):
+    for key in list(shared_blocks):
+        matrix_cache.pop(key, None)
+        block = shared_blocks.pop(key)
+        block.close()
+        if unlink and key in owned_blocks:
+            block.unlink()
+        owned_blocks.discard(key)
+
+def attach_shared_memory(name):
+    # Attaching registers the block with this process's resource tracker, which unlinks it when the process exits
+    # (bpo-39959) and would pull it from under the owner and the other workers. Only the creator registers here
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
 # Utility Functions
 
+# Window statistics over x[i..j] (both ends inclusive) for any i <= j in O(1): prefix sums for sums, Welford prefixes
+# for variances and sparse tables of arg-extrema for maxima and minima. Queries broadcast over arrays of i and j, and
+# windows with j < i take the same fill values as the dense matrices.
+
+def numpy_prefix_moments(x):
+    means = numpy.concatenate(([0.0], numpy.cumsum(x) / numpy.arange(1, x.shape[0] + 1)))
+    return (means, numpy.concatenate(([0.0], numpy.cumsum((x - means[:-1]) * (x - means[1:])))))
+
+@kernel(numpy_prefix_moments)
+def prefix_moments(x):
+    n = x.shape[0]
+    means = numpy.zeros(n + 1)
+    m2s = numpy.zeros(n + 1)
+    for k in range(n):
+        delta = x[k] - means[k]
+        means[k + 1] = means[k] + delta / (k + 1)
+        m2s[k + 1] = m2s[k] + delta * (x[k] - means[k + 1])
+    return (means, m2s)
+
+class WindowStats(object):
+    def __init__(self, x):
+        self.x = numpy.asarray(x, dtype=numpy.float64)
+        n = self.x.shape[0]
+        self.n = n
+        self.sums = numpy.concatenate(([0.0], numpy.cumsum(self.x)))
+        counts = numpy.arange(1, n + 1)
+        (self.means, self.m2s) = prefix_moments(self.x)
+        self.logs = numpy.concatenate(([0], numpy.floor(numpy.log2(numpy.maximum(counts, 1))).astype(numpy.int64)))
+        self.argmaxs = self.sparse_table(lambda a, b: self.x[a] >= self.x[b])
+        self.argmins = self.sparse_table(lambda a, b: self.x[a] <= self.x[b])
+    def sparse_table(self, keep_left):
+        levels = [numpy.arange(self.n)]
+        k = 1
+        while 2 * k <= self.n:
+            left = levels[-1][:self.n - 2 * k + 1]
+            right = levels[-1][k:self.n - k + 1]
+            levels += [numpy.where(keep_left(left, right), left, right)]
+            k *= 2
+        table = numpy.zeros((len(levels), self.n), dtype=numpy.int64)
+        for (k, level) in enumerate(levels):
+            table[k, :len(level)] = level
+        return table
+    def windows(self, i, j):
+        i = numpy.asarray(i, dtype=numpy.int64)
+        j = numpy.asarray(j, dtype=numpy.int64)
+        return (i, j, j >= i)
+    def count(self, i, j):
+        (i, j, valid) = self.windows(i, j)
+        return numpy.where(valid, j - i + 1, 0)
+    def sum(self, i, j):
+        (i, j, valid) = self.windows(i, j)
+        return numpy.where(valid, self.sums[numpy.maximum(j + 1, i)] - self.sums[i], 0.0)
+    def mean(self, i, j):
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return self.sum(i, j) / self.count(i, j)
+    def var(self, i, j, ddof=1):
+        (i, j, valid) = self.windows(i, j)
+        na = i
+        nb = numpy.maximum(j + 1, i)
+        nr = nb - na
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mr = (self.sums[nb] - self.sums[na]) / nr
+            m2 = self.m2s[nb] - self.m2s[na] - numpy.where(na > 0, (mr - self.means[na]) ** 2 * na * nr / nb, 0.0)
+            return numpy.where(valid & (nr > ddof), numpy.maximum(m2, 0.0) / (nr - ddof), numpy.nan)
+    def arg(self, table, i, j, keep_left):
+        (i, j, valid) = self.windows(i, j)
+        j = numpy.maximum(i, j)
+        k = self.logs[j - i + 1]
+        left = table[k, i]
+        right = table[k, j - (1 << k) + 1]
+        return (numpy.where(keep_left(left, right), left, right), valid)
+    def argmax(self, i, j):
+        return self.arg(self.argmaxs, i, j, lambda a, b: self.x[a] >= self.x[b])[0]
+    def argmin(self, i, j):
+        return self.arg(self.argmins, i, j, lambda a, b: self.x[a] <= self.x[b])[0]
+    def max(self, i, j):
+        (index, valid) = self.arg(self.argmaxs, i, j, lambda a, b: self.x[a] >= self.x[b])
+        return numpy.where(valid, self.x[index], -numpy.inf)
+    def min(self, i, j):
+        (index, valid) = self.arg(self.argmins, i, j, lambda a, b: self.x[a] <= self.x[b])
+        return numpy.where(valid, self.x[index], numpy.inf)
+    def last_column(self, stat):
+        return getattr(self, stat)(numpy.arange(self.n), self.n - 1)
+    def window(self, stat):
+        return Windows(self.n, getattr(self, stat))
+    def matrix(self, stat):
+        # Dense n x n opt-in, [i, j] for the window x[i..j]
+        (i, j) = numpy.indices((self.n, self.n))
+        return getattr(self, stat)(i, j)
+
+# Lazy n x n window matrices: [i, j] comes from f(i, j) on broadcast index arrays, so only the windows asked for are
+# computed. They index like the dense matrices and combine with each other, with scalars, with n x n arrays and with
+# length-n arrays (broadcast along j, as before) into new lazy matrices. matrix() materialises one, chunk columns at a time.
+
+def window_values(x, i, j):
+    if isinstance(x, Windows):
+        return x.f(i, j)
+    if isinstance(x, numpy.ndarray) and x.ndim == 2:
+        return x[i, j]
+    if isinstance(x, numpy.ndarray) and x.ndim == 1:
+        return x[j]
+    return x
+
+def window_map(f, *args):
+    lazy = [ x for x in args if isinstance(x, Windows) ]
+    if len(lazy) < 1:
+        return f(*args)
+    return Windows(lazy[0].n, lambda i, j: f(*[ window_values(x, i, j) for x in args ]))
+
+class Windows(object):
+    __array_ufunc__ = None
+    def __init__(self, n, f):
+        self.n = n
+        self.f = f
+        self.shape = (n, n)
+    def __getitem__(self, key):
+        (ki, kj) = key
+        i = numpy.arange(self.n)[ki]
+        j = numpy.arange(self.n)[kj]
+        if (isinstance(ki, slice) or isinstance(kj, slice)) and i.ndim > 0 and j.ndim > 0:
+            i = i.reshape((-1, 1))
+        return self.f(*numpy.broadcast_arrays(i, j))
+    def matrix(self, chunk=None):
+        out = numpy.zeros((self.n, self.n))
+        for js in chunks(self.n, chunk):
+            out[:, js] = self[:, js]
+        return out
+    def __add__(self, other):
+        return window_map(numpy.add, self, other)
+    def __radd__(self, other):
+        return window_map(numpy.add, other, self)
+    def __sub__(self, other):
+        return window_map(numpy.subtract, self, other)
+    def __rsub__(self, other):
+        return window_map(numpy.subtract, other, self)
+    def __mul__(self, other):
+        return window_map(numpy.multiply, self, other)
+    def __rmul__(self, other):
+        return window_map(numpy.multiply, other, self)
+    def __truediv__(self, other):
+        return window_map(numpy.true_divide, self, other)
+    def __rtruediv__(self, other):
+        return window_map(numpy.true_divide, other, self)
+    def __pow__(self, other):
+        return window_map(numpy.power, self, other)
+    def __neg__(self):
+        return window_map(numpy.negative, self)
+    def __gt__(self, other):
+        return window_map(numpy.greater, self, other)
+    def __lt__(self, other):
+        return window_map(numpy.less, self, other)
+
+def get_static_window(name, n):
+    return Windows(n, static_windows[name])
+
+def window_stats(x):
+    return x if isinstance(x, WindowStats) else WindowStats(x)
+
 def subsequence_maxs(x):
-    return numpy.maximum.accumulate(numpy.where(numpy.tri(x.shape[0], k=-1, dtype=bool), -numpy.inf, x), axis=1)
+    return window_stats(x).matrix("max")
 
 def subsequence_mins(x):
-    return numpy.minimum.accumulate(numpy.where(numpy.tri(x.shape[0], k=-1, dtype=bool), numpy.inf, x), axis=1)
+    return window_stats(x).matrix("min")
 
 def subsequence_sums(x):
-    return numpy.cumsum(x * (1 - numpy.tri(x.shape[0], k=-1, dtype=bool)), axis=1)
+    return window_stats(x).matrix("sum")
+
+def subsequence_vars(x):
+    return window_stats(x).matrix("var")
 
-def subsequence_vars(x, nmatrix=None, n1matrix=None):
-    return (numpy.cumsum(x * x * (1 - numpy.tri(x.shape[0], k=-1, dtype=bool)), axis=1) - numpy.cumsum(x * (1 - numpy.tri(x.shape[0], k=-1, dtype=bool)), axis=1) ** 2 / (nmat(x.shape[0]) if nmatrix is None else nmatrix)) / (n1mat(x.shape[0]) if n1matrix is None else n1matrix)
+def chunks(n, chunk=None):
+    chunk = n if chunk is None else max(int(chunk), 1)
+    return [ numpy.arange(start, min(start + chunk, n)) for start in range(0, n, chunk) ]
 
-def subsequence_ecdf(x, w):
+def subsequence_ecdf(x, w, chunk=None):
+    # [i, j] is the w-weighted share of x[i..j] at or below x[j], from per-j prefix sums over k; chunk bounds the rows held at once
     n = x.shape[0]
-    return numpy.sum(numpy.where((1 - numpy.tri(n, k=-1, dtype=bool)).reshape((n, 1, n)).repeat(n, axis=1) & numpy.tri(n, dtype=bool).reshape((1, n, n)).repeat(n, axis=0) & (x.reshape((n, 1)).repeat(n, axis=1) >= x).reshape((1, n, n)).repeat(n, axis=0), w, 0), axis=2) / subsequence_sums(w)
+    out = numpy.zeros((n, n))
+    for js in chunks(n, chunk):
+        sums = numpy.concatenate((numpy.zeros((len(js), 1)), numpy.cumsum(numpy.where(x[js].reshape((len(js), 1)) >= x, w, 0), axis=1)), axis=1)
+        out[:, js] = numpy.where(numpy.arange(n).reshape((n, 1)) <= js, sums[numpy.arange(len(js)), js + 1] - sums[:, :n].T, 0)
+    return out / subsequence_sums(w)
+
+def suffix_sums(x):
+    return numpy.concatenate((numpy.cumsum(x[:, ::-1], axis=1)[:, ::-1], numpy.zeros((x.shape[0], 1))), axis=1)
+
+def clipped_suffix_sums(U, D, M, chunk=None):
+    # Lazy [i, j] = sum over k > j of clip((U[k] - M[i, j]) / (U[k] - D[k]), 0, 1), from suffix sums over k sorted by U and by D
+    n = U.shape[0]
+    R = U - D
+    zero = R == 0
+    c = numpy.mean(U)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        a = numpy.where(zero, 0.0, (U - c) / R)
+        b = numpy.where(zero, 0.0, 1.0 / R)
+    orderU = numpy.argsort(U, kind='stable')
+    orderD = numpy.argsort(D, kind='stable')
+    def columns(js):
+        rows = numpy.arange(len(js))
+        activeU = orderU > js.reshape((len(js), 1))
+        activeD = orderD > js.reshape((len(js), 1))
+        m = M[:, js]
+        above = numpy.searchsorted(U[orderU], m, side='right')
+        at = numpy.searchsorted(U[orderU], m, side='left')
+        within = numpy.searchsorted(D[orderD], m, side='left')
+        zeros = suffix_sums(activeU * zero[orderU])
+        with numpy.errstate(invalid='ignore'):
+            # Bars with D[k] >= M count fully, bars with D[k] < M < U[k] count pro rata, and flat bars at M are undefined as before
+            return suffix_sums(activeD * 1.0)[rows, within] \
+                + suffix_sums(activeU * a[orderU])[rows, above] - (m - c) * suffix_sums(activeU * b[orderU])[rows, above] \
+                - suffix_sums(activeD * a[orderD])[rows, within] + (m - c) * suffix_sums(activeD * b[orderD])[rows, within] \
+                + numpy.where(zeros[rows, at] > zeros[rows, above], numpy.nan, 0.0)
+    def f(i, j):
+        # Only the columns asked for, chunk at a time
+        (js, index) = numpy.unique(j, return_inverse=True)
+        out = numpy.zeros((n, len(js)))
+        for ks in chunks(len(js), chunk):
+            out[:, ks] = columns(js[ks])
+        return out[i, index.reshape(j.shape)]
+    return Windows(n, f)
+
+# Feature registry
+# Each fill_* declares the data keys it writes, the keys it reads, the static matrices it takes by keyword, whether it
+# reads the bars themselves and whether it takes a column chunk. compute_features runs only the fills needed for the
+# requested keys, each at most once. The n x n features come out as lazy Windows, unless dense is set or a chunk is
+# given: then each fill gets the cached static matrices and its outputs are materialised, chunk columns at a time.
+
+Feature = namedtuple("Feature", ["fill", "outputs", "inputs", "matrices", "source", "chunked"])
+
+features = {}
+
+def feature(outputs, inputs=[], matrices={}, source=False, chunked=False):
+    def register(fill):
+        for output in outputs:
+            features[output] = Feature(fill=fill, outputs=outputs, inputs=inputs, matrices=matrices, source=source, chunked=chunked)
+        return fill
+    return register
+
+def compute_features(foo, names, data=None, dense=False, chunk=None):
+    foo = bars.to_bar_array(foo)
+    data = {} if data is None else data
+    dense = dense or chunk is not None
+    n = len(foo)
+    pending = set()
+    def resolve(name):
+        if name in data:
+            return
+        if name not in features:
+            raise KeyError("Unknown feature: %s" % name)
+        f = features[name]
+        if f.fill in pending:
+            raise ValueError("Cyclic feature: %s" % name)
+        pending.add(f.fill)
+        for i in f.inputs:
+            resolve(i)
+        kwargs = { k: (get_static_matrix(m, n) if dense else get_static_window(m, n)) for (k, m) in f.matrices.items() }
+        if f.chunked:
+            kwargs["chunk"] = chunk
+        if f.source:
+            f.fill(foo, data, **kwargs)
+        else:
+            f.fill(data, **kwargs)
+        if dense:
+            for output in f.outputs:
+                if isinstance(data[output], Windows):
+                    data[output] = data[output].matrix(chunk)
+        pending.discard(f.fill)
+    for name in names:
+        resolve(name)
+    return data
 
 # Component functions
 
 def fill_data(foo, data):
-    data["O"] = numpy.log(numpy.array([bar.px_open for bar in foo]))
-    data["U"] = numpy.log(numpy.array([bar.px_high for bar in foo]))
-    data["D"] = numpy.log(numpy.array([bar.px_low for bar in foo]))
-    data["C"] = numpy.log(numpy.array([bar.px_last for bar in foo]))
+    fill_prices(foo, data)
+    fill_extrema(data)
+    fill_volume(foo, data)
+    fill_pairs(data)
+
+@feature(["O", "U", "D", "C", "o", "u", "d", "c"], source=True)
+def fill_prices(foo, data):
+    foo = bars.to_bar_array(foo)
+    data["O"] = numpy.log(foo.px_open)
+    data["U"] = numpy.log(foo.px_high)
+    data["D"] = numpy.log(foo.px_low)
+    data["C"] = numpy.log(foo.px_last)
     data["o"] = data["O"] - numpy.concatenate((data["O"][0:1], data["C"][:-1]))
     data["u"] = data["U"] - data["O"]
     data["d"] = data["D"] - data["O"]
     data["c"] = data["C"] - data["O"]
-    data["maxU"] = subsequence_maxs(data["U"])
-    data["minD"] = subsequence_mins(data["D"])
-    # 
-    data["volume"] = numpy.array([bar.px_volume for bar in foo])
+
+@feature(["maxU", "minD"], ["U", "D"])
+def fill_extrema(data):
+    data["maxU"] = window_stats(data["U"]).window("max")
+    data["minD"] = window_stats(data["D"]).window("min")
+
+@feature(["volume", "value", "vwap"], ["O", "U", "D", "C"], source=True)
+def fill_volume(foo, data):
+    foo = bars.to_bar_array(foo)
+    data["volume"] = numpy.array(foo.px_volume)
     data["value"] = (data["O"] + data["U"] + data["D"] + data["C"]) / 4 * data["volume"]
-    data["vwap"] = subsequence_sums(data["value"]) / subsequence_sums(data["volume"])
-    #
+    data["vwap"] = window_stats(data["value"]).window("sum") / window_stats(data["volume"]).window("sum")
+
+@feature(["2O", "2U", "2D", "2C", "2volume", "2value"], ["O", "U", "D", "C", "volume"])
+def fill_pairs(data):
     data["2O"] = numpy.concatenate((data["O"][:-1], numpy.array([numpy.nan])))
     data["2U"] = numpy.concatenate((numpy.maximum(data["U"][:-1], data["U"][1:]), numpy.array([numpy.nan])))
     data["2D"] = numpy.concatenate((numpy.minimum(data["D"][:-1], data["D"][1:]), numpy.array([numpy.nan])))
@@ -88,29 +544,41 @@ def fill_data(foo, data):
 
 # Price Analytics
 
-def fill_vo(data, nmatrix=None, n1matrix=None):
-    data["vo"] = subsequence_vars(data["o"], nmatrix=nmatrix, n1matrix=n1matrix)
+@feature(["vo"], ["o"])
+def fill_vo(data):
+    data["vo"] = window_stats(data["o"]).window("var")
 
-def fill_vc(data, nmatrix=None, n1matrix=None):
-    data["vc"] = subsequence_vars(data["c"], nmatrix=nmatrix, n1matrix=n1matrix)
+@feature(["vc"], ["c"])
+def fill_vc(data):
+    data["vc"] = window_stats(data["c"]).window("var")
 
+@feature(["vrs"], ["u", "d", "c"], {"nmatrix": "nmat"})
 def fill_vrs(data, nmatrix=None):
-    data["vrs"] = subsequence_sums(data["u"] * (data["u"] - data["c"]) + data["d"] * (data["d"] - data["c"])) / (nmat(data["c"].shape[0]) if nmatrix is None else nmatrix)
+    nmatrix = get_static_window("nmat", data["c"].shape[0]) if nmatrix is None else nmatrix
+    data["vrs"] = window_stats(data["u"] * (data["u"] - data["c"]) + data["d"] * (data["d"] - data["c"])).window("sum") / nmatrix
 
+@feature(["vs"], ["vo", "vc", "vrs"], {"kmatrix": "kmat"})
 def fill_vs(data, kmatrix=None):
-    data["vs"] = data["vo"] + (kmat(data["c"].shape[0]) if kmatrix is None else kmatrix) * data["vc"] + (1 - (kmat(data["c"].shape[0]) if kmatrix is None else kmatrix)) * data["vrs"]
+    kmatrix = get_static_window("kmat", data["c"].shape[0]) if kmatrix is None else kmatrix
+    data["vs"] = data["vo"] + kmatrix * data["vc"] + (1 - kmatrix) * data["vrs"]
 
+@feature(["vl"], ["maxU", "minD"])
 def fill_vl(data):
     data["vl"] = (data["maxU"] - data["minD"]) ** 2 / (4 * numpy.log(2))
 
+@feature(["vr", "vr2"], ["vs", "vrs", "vl"], {"nmatrix": "nmat"})
 def fill_vr(data, nmatrix=None):
-    data["vr"] = data["vs"] * (nmat(data["c"].shape[0]) if nmatrix is None else nmatrix) / data["vl"]
-    data["vr2"] = data["vrs"] * (nmat(data["c"].shape[0]) if nmatrix is None else nmatrix) / data["vl"]
+    nmatrix = get_static_window("nmat", data["c"].shape[0]) if nmatrix is None else nmatrix
+    data["vr"] = data["vs"] * nmatrix / data["vl"]
+    data["vr2"] = data["vrs"] * nmatrix / data["vl"]
 
+@feature(["p", "p2"], ["vr", "vr2"], {"nmatrix": "nmat"})
 def fill_p(data, nmatrix=None):
-    data["p"] = scipy.stats.f.cdf(data["vr"], (nmat(data["c"].shape[0]) if nmatrix is None else nmatrix), 3)
-    data["p2"] = scipy.stats.f.cdf(data["vr2"], (nmat(data["c"].shape[0]) if nmatrix is None else nmatrix), 3)
+    nmatrix = get_static_window("nmat", data["c"].shape[0]) if nmatrix is None else nmatrix
+    data["p"] = window_map(f_cdf, data["vr"], nmatrix, 3)
+    data["p2"] = window_map(f_cdf, data["vr2"], nmatrix, 3)
 
+@feature(["buysemivarianceopen", "buysemivarianceclose", "sellsemivarianceopen", "sellsemivarianceclose", "buysemivariance", "sellsemivariance", "semivariance"], ["o", "u", "d", "c"])
 def fill_semivariance(data):
     data["buysemivarianceopen"] = (data["u"] + numpy.maximum(data["o"], 0)) ** 2
     data["buysemivarianceclose"] = (data["c"] - data["d"]) ** 2
@@ -120,11 +588,14 @@ def fill_semivariance(data):
     data["sellsemivariance"] = data["sellsemivarianceopen"] + data["sellsemivarianceclose"]
     data["semivariance"] = data["buysemivariance"] + data["sellsemivariance"]
 
+@feature(["semivariancer"], ["buysemivariance", "sellsemivariance"])
 def fill_semivariancer(data):
-    data["semivariancer"] = subsequence_sums(data["buysemivariance"]) / subsequence_sums(data["sellsemivariance"])
+    data["semivariancer"] = window_stats(data["buysemivariance"]).window("sum") / window_stats(data["sellsemivariance"]).window("sum")
 
-def fill_semivariancep(data):
-    data["semivariancep"] = scipy.stats.f.cdf(data["semivariancer"], (nmat(data["c"].shape[0]) / 2 if nmatrix is None else nmatrix), (nmat(data["c"].shape[0]) / 2 if nmatrix is None else nmatrix))
+@feature(["semivariancep"], ["semivariancer", "c"], {"nmatrix": "nmat"})
+def fill_semivariancep(data, nmatrix=None):
+    nmatrix = get_static_window("nmat", data["c"].shape[0]) if nmatrix is None else nmatrix
+    data["semivariancep"] = window_map(f_cdf, data["semivariancer"], nmatrix / 2, nmatrix / 2)
 
 # TODO: Price Analytics - Reversals
 
@@ -132,6 +603,7 @@ def fill_semivariancep(data):
 
 # For below, [i, j] as the channel (both ends inclusive), so the (i-1)-th tick is prior to entering the channel, and the (j+1)-th tick breaks
 
+@feature(["breakoutup", "breakoutdown", "breakout"], ["U", "D", "maxU", "minD"])
 def fill_breakout(data):
     data["breakoutup"] = 1.0 * (numpy.concatenate((data["U"][1:], numpy.array([numpy.nan]))) > data["maxU"])
     data["breakoutdown"] = 1.0 * (numpy.concatenate((data["D"][1:], numpy.array([numpy.nan]))) < data["minD"])
@@ -144,22 +616,29 @@ def fill_breakout(data):
 def fill_priorp(data):
     pass
 
+@feature(["highindex", "lowindex", "retracementlow", "retracementhigh"], ["U", "D", "C", "c"])
 def fill_retracement(data):
     n = data["c"].shape[0]
-    data["highindex"] = numpy.argmax(numpy.where(numpy.tri(n, k=-1, dtype=bool), -numpy.inf, data["U"]), axis=1)
-    data["lowindex"] = numpy.argmin(numpy.where(numpy.tri(n, k=-1, dtype=bool), numpy.inf, data["D"]), axis=1)
-    data["retracementlow"] = numpy.nanmin(numpy.concatenate((data["C"][data["highindex"]].reshape((n, 1)), numpy.concatenate((data["minD"][1:, -1], numpy.array([numpy.nan])))[data["highindex"]].reshape((n, 1))), axis=1), axis=1)
-    data["retracementhigh"] = numpy.nanmax(numpy.concatenate((data["C"][data["lowindex"]].reshape((n, 1)), numpy.concatenate((data["maxU"][1:, -1], numpy.array([numpy.nan])))[data["lowindex"]].reshape((n, 1))), axis=1), axis=1)
+    stats_U = window_stats(data["U"])
+    stats_D = window_stats(data["D"])
+    data["highindex"] = stats_U.argmax(numpy.arange(n), n - 1)
+    data["lowindex"] = stats_D.argmin(numpy.arange(n), n - 1)
+    data["retracementlow"] = numpy.nanmin(numpy.concatenate((data["C"][data["highindex"]].reshape((n, 1)), numpy.concatenate((stats_D.last_column("min")[1:], numpy.array([numpy.nan])))[data["highindex"]].reshape((n, 1))), axis=1), axis=1)
+    data["retracementhigh"] = numpy.nanmax(numpy.concatenate((data["C"][data["lowindex"]].reshape((n, 1)), numpy.concatenate((stats_U.last_column("max")[1:], numpy.array([numpy.nan])))[data["lowindex"]].reshape((n, 1))), axis=1), axis=1)
 
 # Post-conditions
 
+@feature(["averagevolume", "volumeratio"], ["volume", "c"], {"nmatrix": "nmat"})
 def fill_volumeratio(data, nmatrix=None):
-    data["averagevolume"] = subsequence_sums(data["volume"]) / (nmat(data["c"].shape[0]) if nmatrix is None else nmatrix)
+    nmatrix = get_static_window("nmat", data["c"].shape[0]) if nmatrix is None else nmatrix
+    data["averagevolume"] = window_stats(data["volume"]).window("sum") / nmatrix
     data["volumeratio"] = data["averagevolume"] / numpy.concatenate((data["averagevolume"][1:, -1], numpy.array([numpy.nan])))
 
+@feature(["volumep"], ["volumeratio", "c"], {"nmatrix": "nmat"})
 def fill_volumep(data, nmatrix=None):
     n = data["c"].shape[0]
-    data["volumep"] = scipy.stats.f.cdf(data["volumeratio"], (nmat(n) if nmatrix is None else nmatrix), numpy.tile(n - numpy.arange(n) - 1, n).reshape((n, n)))
+    nmatrix = get_static_window("nmat", n) if nmatrix is None else nmatrix
+    data["volumep"] = window_map(f_cdf, data["volumeratio"], nmatrix, n - numpy.arange(n) - 1)
 
 #
 
@@ -179,12 +658,11 @@ def fill_volumep(data, nmatrix=None):
 
 #
 
-def fill_time(data):
+@feature(["totaltimeup", "totaltimedown", "proportiontimeup", "proportiontimedown"], ["U", "D", "c", "maxU", "minD"], chunked=True)
+def fill_time(data, chunk=None):
     n = data["c"].shape[0]
-    data["timeup"] = numpy.clip((data["U"].reshape((1, 1, n)).repeat(n, axis=0).repeat(n, axis=1) - data["maxU"].reshape((n, n, 1)).repeat(n, axis=2)) / (data["U"] - data["D"]).reshape((1, 1, n)).repeat(n, axis=0).repeat(n, axis=1), 0.0, 1.0)
-    data["timedown"] = numpy.clip((data["minD"].reshape((n, n, 1)).repeat(n, axis=2) - data["D"].reshape((1, 1, n)).repeat(n, axis=0).repeat(n, axis=1)) / (data["U"] - data["D"]).reshape((1, 1, n)).repeat(n, axis=0).repeat(n, axis=1), 0.0, 1.0)
-    data["totaltimeup"] = numpy.where(numpy.tri(n, k=-1, dtype=bool), numpy.nan, numpy.sum(numpy.where(numpy.tri(n, dtype=bool).reshape((1, n, n)).repeat(n, axis=0), 0, data["timeup"]), axis=2))
-    data["totaltimedown"] = numpy.where(numpy.tri(n, k=-1, dtype=bool), numpy.nan, numpy.sum(numpy.where(numpy.tri(n, dtype=bool).reshape((1, n, n)).repeat(n, axis=0), 0, data["timedown"]), axis=2))
+    data["totaltimeup"] = window_map(numpy.where, get_static_window("strict_tri", n), numpy.nan, clipped_suffix_sums(data["U"], data["D"], data["maxU"], chunk=chunk))
+    data["totaltimedown"] = window_map(numpy.where, get_static_window("strict_tri", n), numpy.nan, clipped_suffix_sums(-data["D"], -data["U"], -data["minD"], chunk=chunk))
     data["proportiontimeup"] = data["totaltimeup"] / (n - numpy.arange(n))
     data["proportiontimedown"] = data["totaltimedown"] / (n - numpy.arange(n))
 